@@ -0,0 +1,309 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import shapely
+import geopandas as gpd
+
+# The benchmarks run the scripts of the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shapefile_utils import generate_random_points_within_shapefile, \
+                            generate_random_points_within_shapefile_parallel, \
+                            split_labels, points_to_gdf, save_folium_map, lat_lon_to_epsg
+from crs_utils import transform_points
+from tile_utils import deg2num, unique_tiles
+from grid_index import GridIndex
+from tile_fetcher import TileJob, download_tiles
+from tile_server import start_tile_server
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+EPSG = 'EPSG:4326'
+
+
+def simple_polygon():
+    # Central belt polygon
+    return shapely.Polygon([(-2.381500, 55.950010), (-2.808075, 56.499314), (-3.543699, 56.434390),
+                            (-4.070388, 56.151770), (-5.010594, 55.918314), (-4.679781, 55.405161)])
+
+
+def coastline_polygon(num_vertices=200000, seed=0):
+    # Scotland-sized polygon with a rough, coastline-like boundary
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 2 * np.pi, num_vertices, endpoint=False)
+    r = 1 + 0.15 * np.sin(80 * t) + 0.03 * np.sin(900 * t) + 0.01 * rng.standard_normal(num_vertices)
+    return shapely.Polygon(np.column_stack((-4 + 2 * r * np.cos(t), 56.6 + 2 * r * np.sin(t)))).buffer(0)
+
+
+def synthetic_points(num_points, seed=0):
+    # (lon, lat) points over Scotland
+    rng = np.random.default_rng(seed)
+    return np.column_stack((rng.uniform(-6, -2, num_points), rng.uniform(55, 58.5, num_points)))
+
+
+def traced_peak(function):
+    # Peak memory traced by tracemalloc during a run of function, in bytes
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def traced_peak_with_workers(function):
+    # Traced peak memory of a run of function, and the peak resident memory of its largest
+    # worker process. The run is in a fresh forked process, whose only children are the
+    # workers of this run: ru_maxrss of the children is a maximum over every child reaped
+    # so far, so in this process it would repeat the peak of an earlier benchmark
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+
+    def run():
+        peak = traced_peak(function)
+        sender.send((peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss))
+
+    process = multiprocessing.get_context('fork').Process(target=run)
+    process.start()
+    sender.close()
+    try:
+        return receiver.recv()
+    finally:
+        process.join()
+
+
+def measure(name, params, unit, function, processes=False):
+    # Run a benchmark, function returns the number of processed items. The throughput is
+    # timed without tracing, and the peak memory is traced in a second run: tracemalloc
+    # slows down the allocation-heavy numpy, shapely and folium paths
+    start = time.perf_counter()
+    count = function()
+    seconds = time.perf_counter() - start
+    result = {
+        'name': name,
+        'params': params,
+        'count': count,
+        'seconds': seconds,
+        'throughput': count / seconds if seconds > 0 else float('inf'),
+        'unit': unit,
+    }
+    workers = ''
+    if processes:
+        # tracemalloc only sees the main process: peak resident memory of the largest
+        # worker process (ru_maxrss is in kB on Linux, in bytes on macOS)
+        peak, maxrss = traced_peak_with_workers(function)
+        result['workers_peak_mb'] = maxrss / (1e6 if sys.platform == 'darwin' else 1e3)
+        workers = f"  {result['workers_peak_mb']:>9.1f} MB per worker"
+    else:
+        peak = traced_peak(function)
+    result['peak_mb'] = peak / 1e6
+    print(f"{name:<32} {json.dumps(params, sort_keys=True):<48} "
+          f"{result['throughput']:>14.1f} {unit}  {result['peak_mb']:>9.1f} MB{workers}")
+    return result
+
+
+def bench_sampling(scale, workers):
+    results = []
+    num_points = int(200000 * scale)
+    for polygon_name, polygon in [('simple', simple_polygon()), ('coastline', coastline_polygon())]:
+        shapefile = gpd.GeoDataFrame(geometry=[polygon], crs=EPSG)
+        for method in ['rejection', 'triangulation']:
+            results.append(measure('sampling', {'polygon': polygon_name, 'method': method}, 'points/s',
+                                   lambda: len(generate_random_points_within_shapefile(
+                                       shapefile, num_points, seed=0, method=method))))
+        index = GridIndex.build(polygon)
+        results.append(measure('sampling', {'polygon': polygon_name, 'method': 'rejection-grid'}, 'points/s',
+                               lambda: len(generate_random_points_within_shapefile(
+                                   shapefile, num_points, seed=0, index=index))))
+        for num_workers in workers:
+            results.append(measure('sampling_parallel', {'polygon': polygon_name, 'workers': num_workers},
+                                   'points/s',
+                                   lambda: len(generate_random_points_within_shapefile_parallel(
+                                       shapefile, num_points, seed=0, num_workers=num_workers)),
+                                   processes=True))
+    return results
+
+
+def bench_tiling(scale):
+    points = synthetic_points(int(1000000 * scale))
+    small = points[:int(20000 * scale)]
+    return [
+        measure('deg2num', {'impl': 'scalar'}, 'points/s',
+                lambda: len([deg2num(lat, lon, 17) for lon, lat in small.tolist()])),
+        measure('deg2num', {'impl': 'unique_tiles'}, 'points/s',
+                lambda: len(unique_tiles(points, 17)[1])),
+        measure('reproject', {'impl': 'scalar'}, 'points/s',
+                lambda: len([lat_lon_to_epsg(lat, lon, 'EPSG:27700') for lon, lat in small.tolist()])),
+        measure('reproject', {'impl': 'batched'}, 'points/s',
+                lambda: len(transform_points(points, 'EPSG:4326', 'EPSG:27700'))),
+    ]
+
+
+def bench_splitting(scale):
+    points = synthetic_points(int(1000000 * scale))
+    return [measure('split', {'method': method}, 'points/s',
+                    lambda: len(split_labels(points, method, degrees=0.1, ratios=[0.8, 0.1, 0.1], seed=0)))
+            for method in ['checkerboard', 'random', 'tiles']]
+
+
+def bench_folium(scale):
+    gdf = points_to_gdf(synthetic_points(int(50000 * scale)), EPSG)
+    path = tempfile.mkdtemp()
+    try:
+        return [measure('folium', {'mode': mode}, 'points/s',
+                        lambda: save_folium_map(gdf, path, mode, mode=mode) or len(gdf))
+                for mode in ['fast', 'heatmap']]
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_download(scale, concurrencies, latency, error_rate, port):
+    results = []
+    num_tiles = int(5000 * scale)
+    port, stop = start_tile_server(port, latency=latency, error_rate=error_rate)
+    apis = {'bench': {'url': f'http://127.0.0.1:{port}/{{z}}/{{x}}/{{y}}.png', 'rate': 1e9, 'burst': 1e9,
+                      'retry_delay': 0.01, 'max_retry_delay': 0.1}}
+    try:
+        for concurrency in concurrencies:
+            path = tempfile.mkdtemp()
+            try:
+                # The jobs are created for each run of the benchmark
+                jobs = lambda: (TileJob('bench', 17, i, 0, f'{path}/{i}.png') for i in range(num_tiles))
+                results.append(measure('download', {'concurrency': concurrency, 'latency': latency,
+                                                    'error_rate': error_rate}, 'tiles/s',
+                                       lambda: download_tiles(jobs(), apis, concurrency=concurrency)
+                                       ['bench']['downloaded']))
+            finally:
+                shutil.rmtree(path)
+    finally:
+        stop()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Ratio of the throughput of each benchmark to the baseline, and the regressions
+    key = lambda result: (result['name'], json.dumps(result['params'], sort_keys=True))
+    baseline = {key(result): result for result in baseline['results']}
+    regressions = []
+    print("\nComparison with the baseline:")
+    for result in results:
+        if key(result) not in baseline:
+            continue
+        ratio = result['throughput'] / baseline[key(result)]['throughput']
+        result['baseline_ratio'] = ratio
+        flag = 'REGRESSION' if ratio < 1 - tolerance else ''
+        print(f"{result['name']:<32} {key(result)[1]:<48} {ratio:>8.2f}x {flag}")
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+def parse_args():
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Benchmarks of the sampling, tiling, splitting and download hot paths.')
+
+    parser.add_argument('--suites',
+                        type=str,
+                        nargs='+',
+                        default=['sampling', 'tiling', 'splitting', 'folium', 'download'],
+                        help='Benchmark suites to run.')
+    parser.add_argument('--scale',
+                        type=float,
+                        default=1.0,
+                        help='Scale of the problem sizes, e.g. 0.1 for a quick run.')
+    parser.add_argument('--workers',
+                        type=int,
+                        nargs='+',
+                        default=[1, 2, 4, os.cpu_count()],
+                        help='Worker counts for the parallel sampler.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        nargs='+',
+                        default=[16, 64, 256],
+                        help='Concurrency levels for the downloads.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.05,
+                        help='Latency of the stand-in tile server in seconds.')
+    parser.add_argument('--error_rate',
+                        type=float,
+                        default=0.01,
+                        help='Error rate of the stand-in tile server.')
+    parser.add_argument('--port',
+                        type=int,
+                        default=0,
+                        help='Port of the stand-in tile server, 0 picks a free one.')
+    parser.add_argument('--output',
+                        type=str,
+                        default=f'{BENCHMARKS_PATH}/results.json',
+                        help='Results file.')
+    parser.add_argument('--baseline',
+                        type=str,
+                        default=f'{BENCHMARKS_PATH}/baseline.json',
+                        help='Baseline results file to compare with.')
+    parser.add_argument('--save_baseline',
+                        action='store_true',
+                        default=False,
+                        help='Save the results as the new baseline.')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.2,
+                        help='Relative throughput drop reported as a regression.')
+
+    return parser.parse_args()
+
+
+def main():
+
+    args = parse_args()
+
+    # Each benchmark runs twice: timed, then traced for its peak memory
+    print("Throughput of a timed run, peak memory (MB) of a second, traced run of each benchmark\n")
+    results = []
+    if 'sampling' in args.suites:
+        results += bench_sampling(args.scale, sorted(set(args.workers)))
+    if 'tiling' in args.suites:
+        results += bench_tiling(args.scale)
+    if 'splitting' in args.suites:
+        results += bench_splitting(args.scale)
+    if 'folium' in args.suites:
+        results += bench_folium(args.scale)
+    if 'download' in args.suites:
+        results += bench_download(args.scale, args.concurrency, args.latency, args.error_rate, args.port)
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'shapely': shapely.__version__,
+            'scale': args.scale,
+        },
+        'results': results,
+    }
+    output = args.baseline if args.save_baseline else args.output
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+    if regressions:
+        print(f"{len(regressions)} regressions")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import asyncio
+import random
+import threading
+
+from aiohttp import web
+
+# Smallest valid PNG header, padded to the requested tile size
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def make_app(latency=0.0, error_rate=0.0, throttle_rate=0.0, tile_size=20000, seed=0):
+    # Stand-in tile server: every tile is served after latency seconds, and fails
+    # with a 500 (error_rate) or a 429 with Retry-After (throttle_rate) at random
+    rng = random.Random(seed)
+    body = PNG_SIGNATURE + bytes(max(tile_size - len(PNG_SIGNATURE), 0))
+
+    async def tile(request):
+        await asyncio.sleep(latency)
+        u = rng.random()
+        if u < error_rate:
+            return web.Response(status=500)
+        if u < error_rate + throttle_rate:
+            return web.Response(status=429, headers={'Retry-After': '1'})
+        return web.Response(body=body, content_type='image/png')
+
+    app = web.Application()
+    app.router.add_get('/{z}/{x}/{y}.png', tile)
+    return app
+
+
+def start_tile_server(port=0, **kwargs):
+    # Run the server in a background thread, returns its port (a free one
+    # is picked when port is 0) and a function to stop it
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(**kwargs))
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', port).start())
+    port = runner.addresses[0][1]
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+    return port, stop
+
+
+def parse_args():
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Local stand-in tile server.')
+
+    parser.add_argument('--port',
+                        type=int,
+                        default=8765,
+                        help='Port to listen on.')
+    parser.add_argument('--latency',
+                        type=float,
+                        default=0.05,
+                        help='Latency of every request in seconds.')
+    parser.add_argument('--error_rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests failing with a 500.')
+    parser.add_argument('--throttle_rate',
+                        type=float,
+                        default=0.0,
+                        help='Fraction of requests throttled with a 429.')
+    parser.add_argument('--tile_size',
+                        type=int,
+                        default=20000,
+                        help='Size of the tiles in bytes.')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    web.run_app(make_app(args.latency, args.error_rate, args.throttle_rate, args.tile_size),
+                host='127.0.0.1', port=args.port)
@@ -0,0 +1,112 @@
+import argparse
+import os
+
+import numpy as np
+
+from tile_pyramid import build_level, build_mosaic_set, mosaic_windows
+from tile_sampler import tile_centers
+
+
+def parse_args():
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Build lower zoom tiles and context mosaics from the downloaded tiles.')
+
+    parser.add_argument('--apis',
+                        type=str,
+                        nargs='+',
+                        default=['worldimagery-clarity', 'openstreetmap'],
+                        help='APIs to use. Example: worldimagery-clarity, openstreetmap.')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level of the downloaded tiles.')
+    parser.add_argument('--levels',
+                        type=int,
+                        default=1,
+                        help='Number of lower zoom levels to build, each from 2x2 tiles of the level above. 0 to skip.')
+    parser.add_argument('--min_children',
+                        type=int,
+                        default=4,
+                        help='Minimum number of the 2x2 tiles in the store to build a lower zoom tile.')
+    parser.add_argument('--pfile',
+                        type=str,
+                        default=None,
+                        help='Points file to build the context mosaics for. Example: central-belt1000.')
+    parser.add_argument('--mosaic_tiles',
+                        type=int,
+                        default=2,
+                        help='Width of the context mosaics in tiles, e.g. 2 for 512px mosaics.')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of parallel workers.')
+    parser.add_argument('--root',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Root folder.')
+    parser.add_argument('--save_root',
+                        type=str,
+                        default='dataset',
+                        help='Root folder of the tiles.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Shared tile store folder. Default: {save_root}/tile_store.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # HACK: Manually set the arguments
+    if args.store is None:
+        args.store = f'{args.save_root}/tile_store'
+    if args.pfile is not None:
+        args.coords_path = f'{args.root}/results/{args.pfile}'
+        args.mosaics_path = f'{args.save_root}/mosaics_{args.pfile}'
+        args.context_pfile = f'{args.pfile}-context'
+        args.context_path = f'{args.root}/results/{args.context_pfile}'
+
+    return args
+
+
+def main():
+
+    args = parse_args()
+
+    # Lower zoom tiles, added to the store next to the downloaded ones, so
+    # that download_tiles.py at a lower zoom takes them from the store
+    for api in args.apis:
+        for zoom in range(args.zoom, args.zoom - args.levels, -1):
+            built = build_level(args.store, api, zoom, min_children=args.min_children, workers=args.workers)
+            print(f"{api}: {built} tiles built at zoom {zoom - 1}")
+
+    if args.pfile is None:
+        return
+
+    # Context mosaics around the points
+    n = args.mosaic_tiles
+    coordinates = np.load(f'{args.coords_path}/{args.pfile}.npy')
+    windows, point_window = mosaic_windows(coordinates, args.zoom, n)
+    if not os.path.exists(args.mosaics_path):
+        os.makedirs(args.mosaics_path)
+    np.savez(f'{args.mosaics_path}/point_mosaics_z{args.zoom}_{n}x{n}.npz',
+             windows=windows, point_window=point_window, zoom=args.zoom, size=n)
+    print(f"{len(coordinates)} points fall in {len(windows)} {n}x{n} mosaics")
+
+    missing = set()
+    for api in args.apis:
+        built, api_missing = build_mosaic_set(args.store, api, args.zoom, windows, n,
+                                              f'{args.mosaics_path}/{api}', workers=args.workers)
+        missing.update(api_missing)
+        print(f"{api}: {built} mosaics built, {len(api_missing)} tiles missing from the store")
+
+    # The neighbouring tiles missing from the store are saved as a points file,
+    # to download them with download_tiles.py --pfile {pfile}-context
+    if missing:
+        if not os.path.exists(args.context_path):
+            os.makedirs(args.context_path)
+        np.save(f'{args.context_path}/{args.context_pfile}.npy', tile_centers(np.array(sorted(missing)), args.zoom))
+        print(f"Download the missing tiles with: python download_tiles.py --pfile {args.context_pfile}")
+
+
+if __name__ == '__main__':
+    main()
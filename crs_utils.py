@@ -0,0 +1,57 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+# Coordinate system of the points files, (lon, lat)
+WGS84 = 'EPSG:4326'
+
+# Arrays with more coordinates than this are split into chunks transformed in
+# parallel threads (pyproj releases the GIL while transforming)
+THREAD_CHUNK_SIZE = 500_000
+
+
+@lru_cache(maxsize=32)
+def get_transformer(src, dst):
+    # Transformers are costly to create, they are reused for each (src, dst) pair.
+    # They are thread-safe, so a single one is shared by the threads.
+    # pyproj is imported on first use, most scripts never transform coordinates
+    import pyproj
+    return pyproj.Transformer.from_crs(src, dst, always_xy=True)
+
+
+def transform_coordinates(x, y, src, dst, num_threads=None, chunk_size=THREAD_CHUNK_SIZE):
+    # Transform arrays (or scalars) of x and y coordinates from src to dst, with x, y
+    # the (lon, lat) of geographic systems. Returns arrays of the same shape
+    x = np.array(x, dtype=np.float64)
+    y = np.array(y, dtype=np.float64)
+    if src == dst:
+        return x, y
+    scalar = x.ndim == 0
+    shape = x.shape
+    x, y = x.reshape(-1), y.reshape(-1)
+    transformer = get_transformer(src, dst)
+
+    # The copies are transformed in place, chunk by chunk
+    def transform(start):
+        transformer.transform(x[start:start + chunk_size], y[start:start + chunk_size], inplace=True)
+
+    starts = range(0, len(x), chunk_size)
+    if len(starts) <= 1 or num_threads == 1:
+        for start in starts:
+            transform(start)
+    else:
+        with ThreadPoolExecutor(max_workers=num_threads or os.cpu_count()) as executor:
+            list(executor.map(transform, starts))
+
+    if scalar:
+        return float(x[0]), float(y[0])
+    return x.reshape(shape), y.reshape(shape)
+
+
+def transform_points(points, src, dst, num_threads=None):
+    # Transform an array of shape (N, 2) of (x, y) points, e.g. the (lon, lat) points files
+    points = np.asarray(points, dtype=np.float64)
+    x, y = transform_coordinates(points[:, 0], points[:, 1], src, dst, num_threads=num_threads)
+    return np.column_stack((x, y))
@@ -0,0 +1,191 @@
+import asyncio
+import json
+import math
+import sys
+import time
+from collections import Counter
+
+from aiohttp import web
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class ProviderMetrics:
+    # Counters and request latency histogram of a single provider
+
+    def __init__(self):
+        self.downloaded = 0
+        self.failed = 0
+        self.requests = 0
+        self.retries = 0
+        self.bytes = 0
+        self.statuses = Counter()
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.concurrency = None
+
+    def observe_request(self, status, seconds, size=0):
+        # status is the HTTP status, or the name of the exception for network errors
+        self.requests += 1
+        self.bytes += size
+        self.statuses[str(status)] += 1
+        self.latency_sum += seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def observe_retry(self):
+        self.retries += 1
+
+    def observe_result(self, ok, concurrency=None):
+        if ok:
+            self.downloaded += 1
+        else:
+            self.failed += 1
+        self.concurrency = concurrency
+
+    def quantile(self, q):
+        # Estimated by linear interpolation inside the histogram bucket holding the quantile
+        if self.requests == 0:
+            return None
+        rank = q * self.requests
+        count, lower = 0, 0.0
+        for bound, bucket in zip(LATENCY_BUCKETS, self.buckets):
+            if bucket and count + bucket >= rank:
+                if math.isinf(bound):
+                    return lower
+                return lower + (bound - lower) * (rank - count) / bucket
+            count += bucket
+            lower = bound
+        return lower
+
+    def summary(self, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        return {
+            'downloaded': self.downloaded,
+            'failed': self.failed,
+            'requests': self.requests,
+            'retries': self.retries,
+            'bytes': self.bytes,
+            'tiles_per_s': self.downloaded / elapsed,
+            'mb_per_s': self.bytes / elapsed / 1e6,
+            'latency_mean': self.latency_sum / self.requests if self.requests else None,
+            **{f'latency_p{round(q * 100)}': self.quantile(q) for q in QUANTILES},
+            'statuses': dict(self.statuses),
+            'concurrency': self.concurrency,
+        }
+
+
+class DownloadMetrics:
+    # Instrumentation of the downloads: per-provider metrics, written as JSON lines
+    # every interval seconds (and a final summary) to path, a progress line on
+    # stderr, and optionally served as Prometheus text on http://host:port/metrics
+
+    def __init__(self, path=None, interval=10.0, port=None, host='127.0.0.1'):
+        self.path = path
+        self.interval = interval
+        self.port = port
+        self.host = host
+        self.providers = {}
+        self.started = time.monotonic()
+        self.last_report = (self.started, {})
+        self.reporter = None
+        self.runner = None
+
+    def provider(self, api):
+        if api not in self.providers:
+            self.providers[api] = ProviderMetrics()
+        return self.providers[api]
+
+    def snapshot(self, final=False):
+        now = time.monotonic()
+        elapsed = now - self.started
+        providers = {api: metrics.summary(elapsed) for api, metrics in self.providers.items()}
+
+        # Throughput since the previous report, next to the averages since the start
+        last_time, last_counts = self.last_report
+        for api, summary in providers.items():
+            last_downloaded, last_bytes = last_counts.get(api, (0, 0))
+            summary['recent_tiles_per_s'] = (summary['downloaded'] - last_downloaded) / max(now - last_time, 1e-9)
+            summary['recent_mb_per_s'] = (summary['bytes'] - last_bytes) / max(now - last_time, 1e-9) / 1e6
+        self.last_report = (now, {api: (s['downloaded'], s['bytes']) for api, s in providers.items()})
+
+        return {'time': time.time(), 'elapsed': elapsed, 'final': final, 'providers': providers}
+
+    def report(self, final=False):
+        snapshot = self.snapshot(final)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        for api, s in snapshot['providers'].items():
+            rate = s['tiles_per_s'] if final else s['recent_tiles_per_s']
+            mb_rate = s['mb_per_s'] if final else s['recent_mb_per_s']
+            p50, p95, p99 = (f"{s[f'latency_p{p}']:.2f}s" if s[f'latency_p{p}'] is not None else '-'
+                             for p in (50, 95, 99))
+            print(f"[{snapshot['elapsed']:.0f}s] {api}: {s['downloaded']} downloaded, {s['failed']} failed, "
+                  f"{rate:.1f} tiles/s, {mb_rate:.2f} MB/s, latency p50 {p50} p95 {p95} p99 {p99}, "
+                  f"{s['retries']} retries, statuses {s['statuses']}", file=sys.stderr)
+        return snapshot
+
+    def prometheus(self):
+        # Prometheus text exposition format, the samples of each metric are grouped
+        providers = self.providers.items()
+        lines = ['# TYPE mapsat_tiles_total counter']
+        for api, metrics in providers:
+            lines.append(f'mapsat_tiles_total{{api="{api}",result="downloaded"}} {metrics.downloaded}')
+            lines.append(f'mapsat_tiles_total{{api="{api}",result="failed"}} {metrics.failed}')
+        lines.append('# TYPE mapsat_requests_total counter')
+        for api, metrics in providers:
+            for status, count in sorted(metrics.statuses.items()):
+                lines.append(f'mapsat_requests_total{{api="{api}",status="{status}"}} {count}')
+        lines.append('# TYPE mapsat_retries_total counter')
+        lines.extend(f'mapsat_retries_total{{api="{api}"}} {metrics.retries}' for api, metrics in providers)
+        lines.append('# TYPE mapsat_bytes_total counter')
+        lines.extend(f'mapsat_bytes_total{{api="{api}"}} {metrics.bytes}' for api, metrics in providers)
+        lines.append('# TYPE mapsat_concurrency_limit gauge')
+        lines.extend(f'mapsat_concurrency_limit{{api="{api}"}} {metrics.concurrency}'
+                     for api, metrics in providers if metrics.concurrency is not None)
+        lines.append('# TYPE mapsat_request_duration_seconds histogram')
+        for api, metrics in providers:
+            count = 0
+            for bound, bucket in zip(LATENCY_BUCKETS, metrics.buckets):
+                count += bucket
+                le = '+Inf' if math.isinf(bound) else bound
+                lines.append(f'mapsat_request_duration_seconds_bucket{{api="{api}",le="{le}"}} {count}')
+            lines.append(f'mapsat_request_duration_seconds_sum{{api="{api}"}} {metrics.latency_sum}')
+            lines.append(f'mapsat_request_duration_seconds_count{{api="{api}"}} {metrics.requests}')
+        return '\n'.join(lines) + '\n'
+
+    async def start(self):
+        # Start the periodic reports, and the Prometheus endpoint, in the running event loop
+        self.started = time.monotonic()
+        self.last_report = (self.started, {})
+        self.reporter = asyncio.create_task(self.periodic_report())
+        if self.port is not None:
+            async def handler(request):
+                return web.Response(text=self.prometheus(), content_type='text/plain')
+            app = web.Application()
+            app.router.add_get('/metrics', handler)
+            self.runner = web.AppRunner(app)
+            await self.runner.setup()
+            await web.TCPSite(self.runner, self.host, self.port).start()
+            print(f"Serving download metrics on http://{self.host}:{self.port}/metrics", file=sys.stderr)
+
+    async def periodic_report(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.report()
+
+    async def stop(self):
+        # Stop the reports and write the final summary
+        if self.reporter is not None:
+            self.reporter.cancel()
+            self.reporter = None
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+        return self.report(final=True)
@@ -1,14 +1,17 @@
+import contextlib
 import numpy as np
 import os
-import subprocess
-import math
-from concurrent.futures import ThreadPoolExecutor
-import glob
-import time
+import shutil
+import tempfile
 
 import argparse
 
-def parse_args():
+from tile_manifest import TileManifest, STATUS_DONE, STATUS_FAILED, STATUS_BLANK
+from tile_store import TileStore
+from tile_validation import PLACEHOLDER
+from tile_utils import unique_tiles, save_point_tiles, parse_shard, tile_shards, shard_path
+
+def parse_args(argv=None):
     # Initialize the argument parser
     parser = argparse.ArgumentParser(description='Command line arguments.')
 
@@ -22,10 +25,10 @@ def parse_args():
                         type=int,
                         default=17,
                         help='Zoom level.')
-    parser.add_argument('--threads',
+    parser.add_argument('--concurrency',
                         type=int,
-                        default=os.cpu_count(),
-                        help='Number of threads to use.')
+                        default=None,
+                        help='Maximum number of requests in flight per API. Default: the limit of each API in APIS.')
     parser.add_argument('--apis',
                         type=str,
                         nargs='+',
@@ -39,87 +42,226 @@ def parse_args():
                         type=str,
                         default='dataset',
                         help='Root folder to save the tiles.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Shared tile store folder. Default: {save_root}/tile_store.')
+    parser.add_argument('--export_files',
+                        action='store_true',
+                        default=False,
+                        help='Also write the tiles as per-dataset tile files, besides the shared store.')
+    parser.add_argument('--shard',
+                        type=str,
+                        default=None,
+                        help='Only download the shard i/N of the tiles (0 <= i < N), e.g. on the i-th of N hosts. '
+                             'Merge the shards with merge_shards.py.')
+    parser.add_argument('--shard_block',
+                        type=int,
+                        default=1,
+                        help='Assign blocks of shard_block x shard_block tiles to the same shard.')
+    parser.add_argument('--metrics_interval',
+                        type=float,
+                        default=10.0,
+                        help='Seconds between the download metrics reports.')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        default=None,
+                        help='Serve the download metrics in the Prometheus text format on this port.')
 
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # HACK: Manually set the arguments
     args.coords_path = f'{args.root}/results/{args.pfile}'
     args.tiles_path = f'{args.save_root}/tiles_{args.pfile}'
+    args.shared_store = None
+    if args.shard is not None:
+        # Each shard has its own manifest, tiles and (local) store. The tiles already
+        # in the shared store (if it is on the host) are read from it, without writing to it
+        args.tiles_path = shard_path(args.tiles_path, *parse_shard(args.shard))
+        if args.store is None:
+            args.store = f'{args.tiles_path}/tile_store'
+            args.shared_store = f'{args.save_root}/tile_store'
+    if args.store is None:
+        args.store = f'{args.save_root}/tile_store'
 
     return args
 
-# API urls
+# API urls, and the limits of each provider (see tile_fetcher.DEFAULT_LIMITS)
 APIS = {
-    'worldimagery' : 'https://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-    'worldimagery-clarity': 'https://clarity.maptiles.arcgis.com/arcgis/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
-    'openstreetmap' : 'https://tile.openstreetmap.org/{z}/{x}/{y}.png',
-    'ukosgb1888': 'https://api.maptiler.com/tiles/uk-osgb10k1888/{z}/{x}/{y}.jpg?key=MXVhdLdJmHeZ0z5DwjBI'
+    'worldimagery' : {
+        'url': 'https://services.arcgisonline.com/arcgis/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        'rate': 100, 'concurrency': 64,
+    },
+    'worldimagery-clarity': {
+        'url': 'https://clarity.maptiles.arcgis.com/arcgis/rest/services/World_Imagery/MapServer/tile/{z}/{y}/{x}',
+        'rate': 100, 'concurrency': 64,
+    },
+    'openstreetmap' : {
+        'url': 'https://tile.openstreetmap.org/{z}/{x}/{y}.png',
+        'rate': 20, 'concurrency': 2,
+    },
+    'ukosgb1888': {
+        'url': 'https://api.maptiler.com/tiles/uk-osgb10k1888/{z}/{x}/{y}.jpg?key=MXVhdLdJmHeZ0z5DwjBI',
+        'rate': 25, 'concurrency': 16,
+    },
 }
 
-def deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
-    n = 2.0 ** zoom
-    xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
-    return xtile, ytile
-
-def format_string(url, x, y, zoom):
-    substituted_string = url.replace('{x}', str(x))
-    substituted_string = substituted_string.replace('{y}', str(y))
-    substituted_string = substituted_string.replace('{z}', str(zoom))
-    return substituted_string
-
-def download_tile(url, tile_path, max_retries=5, retry_delay=2):
-    retries = 0
-    while retries < max_retries:
-        try:
-            subprocess.run(["curl", url, '--output', tile_path], check=True)
-            return  # Download successful, exit the function
-        except subprocess.CalledProcessError as e:
-            print(f"Download failed: {e}")
-            retries += 1
-            if retries < max_retries:
-                print(f"Retrying in {retry_delay} seconds...")
-                time.sleep(retry_delay)
+# Number of tiles looked up in the store at once
+LOOKUP_BATCH = 1024
+
+def download(tiles, apis, zoom, tiles_path, store_path, export_files=False, concurrency=None,
+             metrics_interval=10.0, metrics_port=None, shared_store_path=None):
+    # Download an iterable of (x, y) tiles from each of the apis, which can be a
+    # generator (or an async one): tiles are only consumed as the download queues drain.
+    # The tiles are kept in the store at store_path, and only written as per-dataset
+    # tile files in {tiles_path}/{api} with export_files. The tiles of the store at
+    # shared_store_path (e.g. the shared store, for a shard) are also reused, read-only.
+    # Download metrics are appended to {tiles_path}/metrics.jsonl
+    # The download stack (aiohttp) is only imported when something is downloaded
+    from tile_fetcher import TileJob, download_tiles
+    from download_metrics import DownloadMetrics
+    
+    if not os.path.exists(tiles_path):
+        os.makedirs(tiles_path)
+    
+    # Create folders for the different image types. Without per-dataset files, the
+    # tiles are downloaded to a staging folder of the store, one per run, so that
+    # concurrent runs sharing the store do not write and remove each other's files
+    if not export_files:
+        if not os.path.exists(f'{store_path}/incoming'):
+            os.makedirs(f'{store_path}/incoming')
+        tiles_dir = tempfile.mkdtemp(prefix=f'{os.getpid()}-', dir=f'{store_path}/incoming')
+    else:
+        tiles_dir = tiles_path
+    for url in apis:
+        if not os.path.exists(f'{tiles_dir}/{url}'):
+            os.makedirs(f'{tiles_dir}/{url}')
+
+    with TileManifest(f'{tiles_path}/manifest.sqlite') as manifest, TileStore(store_path) as store, \
+            (TileStore(shared_store_path, read_only=True) if shared_store_path else contextlib.nullcontext()) as shared:
+        # Tiles completed by previous runs are skipped
+        completed = {url: manifest.completed(url, zoom) for url in apis}
+        # Tile contents flagged as invalid by validate_tiles.py
+        flagged = {url: {**(shared.flagged(url) if shared is not None else {}), **store.flagged(url)} for url in apis}
+        # Number of tiles taken from the shared store
+        reused = {url: 0 for url in apis}
+        for url in apis:
+            print(f"{url}: {len(completed[url])} tiles already downloaded")
+
+        def tile_jobs(batch):
+            # Download jobs of a batch of tiles, one per tile and API. Tiles downloaded by
+            # any dataset are taken from the shared store, looked up for the whole batch
+            for url in apis:
+                if export_files:
+                    # Tiles completed by a run without files are written from the store
+                    for x, y in batch:
+                        tile_path = f'{tiles_dir}/{url}/{zoom}_{x}_{y}.png'
+                        if (x, y) in completed[url] and not os.path.exists(tile_path):
+                            if not store.export(url, zoom, x, y, tile_path) and shared is not None:
+                                shared.export(url, zoom, x, y, tile_path)
+                batch_tiles = [tile for tile in batch if tile not in completed[url]]
+                stored = store.lookup(url, zoom, batch_tiles)
+                if shared is not None:
+                    shared_stored = shared.lookup(url, zoom, [tile for tile in batch_tiles if tile not in stored])
+                else:
+                    shared_stored = {}
+                for x, y in batch_tiles:
+                    tile_path = f'{tiles_dir}/{url}/{zoom}_{x}_{y}.png'
+                    if (x, y) in stored or (x, y) in shared_stored:
+                        # Reuse the stored tile instead of fetching it again
+                        source, found = (store, stored) if (x, y) in stored else (shared, shared_stored)
+                        if export_files:
+                            source.export(url, zoom, x, y, tile_path)
+                        size, tile_id = found[(x, y)]
+                        status = STATUS_BLANK if flagged[url].get(tile_id) == PLACEHOLDER else STATUS_DONE
+                        manifest.record(url, zoom, x, y, status, size, tile_id)
+                        reused[url] += 1
+                        continue
+                    yield TileJob(url, zoom, x, y, tile_path)
+
+        # Lazily generate the download jobs, by batches of tiles. tiles can be an async
+        # iterable, so that they are produced without blocking the downloads
+        if hasattr(tiles, '__aiter__'):
+            async def jobs():
+                batch = []
+                async for x, y in tiles:
+                    batch.append((x, y))
+                    if len(batch) >= LOOKUP_BATCH:
+                        for job in tile_jobs(batch):
+                            yield job
+                        batch = []
+                for job in tile_jobs(batch):
+                    yield job
+        else:
+            def jobs():
+                batch = []
+                for x, y in tiles:
+                    batch.append((x, y))
+                    if len(batch) >= LOOKUP_BATCH:
+                        yield from tile_jobs(batch)
+                        batch = []
+                yield from tile_jobs(batch)
+        
+        def on_result(job, result):
+            if result is None:
+                manifest.record_result(job, result)
+                return
+            # Tiles identical to a known broken tile (e.g. the same error page) are failed,
+            # and tiles identical to a known placeholder are kept, but marked as blank
+            reason = flagged[job.api].get(result[1])
+            if reason is None or reason == PLACEHOLDER:
+                # Add the new tiles to the shared store
+                store.put_file(job.api, job.zoom, job.x, job.y, job.path, tile_id=result[1])
+            if not export_files or (reason is not None and reason != PLACEHOLDER):
+                os.remove(job.path)
+            if reason is None:
+                manifest.record_result(job, result)
+            elif reason == PLACEHOLDER:
+                manifest.record(job.api, job.zoom, job.x, job.y, STATUS_BLANK, *result)
             else:
-                print("Max retries reached, giving up.")
+                manifest.record(job.api, job.zoom, job.x, job.y, STATUS_FAILED)
+
+        # Download the tiles over pooled connections, recording them in the manifest
+        metrics = DownloadMetrics(f'{tiles_path}/metrics.jsonl', interval=metrics_interval, port=metrics_port)
+        results = download_tiles(jobs(), APIS, concurrency=concurrency, on_result=on_result, metrics=metrics)
+        for url in apis:
+            counts = results.get(url, {'downloaded': 0, 'failed': 0})
+            print(f"{url}: {reused[url]} taken from the store, {counts['downloaded']} downloaded, {counts['failed']} failed")
+
+    if not export_files:
+        shutil.rmtree(tiles_dir)
+    
+    return results
 
-def main():
+def main(args=None):
     
-    args = parse_args()
+    if args is None:
+        args = parse_args()
     
     if not os.path.exists(args.tiles_path):
         os.makedirs(args.tiles_path)
     
-    # Create folders for the different image types
-    for url in args.apis:
-        if not os.path.exists(f'{args.tiles_path}/{url}'):
-            os.makedirs(f'{args.tiles_path}/{url}')
-    
-    # existing_files = {}
-    # for url in APIS:
-    #     existing_files[url] = glob.glob(f'{TILES_PATH}/{url}/*.png')
-    
     # Load the coordinates
     coordinates = np.load(f'{args.coords_path}/{args.pfile}.npy')
 
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        futures = []
-        
-        for coord in coordinates:
-            lon, lat = coord[0], coord[1]
-            x, y = deg2num(lat, lon, zoom=args.zoom)
-            
-            for url in args.apis:
-                tile_url = format_string(APIS[url], x, y, args.zoom)
-                tile_path = f'{args.tiles_path}/{url}/{args.zoom}_{x}_{y}.png'
-                future = executor.submit(download_tile, tile_url, tile_path)
-                futures.append(future)
-        
-        # Wait for all the downloads to complete
-        for future in futures:
-            future.result()
+    # Convert the points to tiles, and keep only the unique ones
+    tiles, point_tile = unique_tiles(coordinates, zoom=args.zoom)
+    print(f"{len(coordinates)} points fall in {len(tiles)} unique tiles")
+    
+    # Save the point -> tile mapping for later use
+    save_point_tiles(f'{args.tiles_path}/point_tiles_z{args.zoom}.npz', tiles, point_tile, args.zoom)
+
+    # Keep only the tiles of the shard
+    if args.shard is not None:
+        index, num_shards = parse_shard(args.shard)
+        tiles = tiles[tile_shards(tiles, num_shards, args.shard_block) == index]
+        print(f"Shard {args.shard}: {len(tiles)} tiles")
+
+    return download(tiles.tolist(), args.apis, args.zoom, args.tiles_path, args.store,
+                    export_files=args.export_files, concurrency=args.concurrency,
+                    metrics_interval=args.metrics_interval, metrics_port=args.metrics_port,
+                    shared_store_path=args.shared_store)
 
 if __name__ == '__main__':
-    main()
+    main()
\ No newline at end of file
@@ -0,0 +1,203 @@
+import argparse
+import io
+import os
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+
+from tile_manifest import TileManifest, STATUS_DONE
+from tile_store import TileStore
+from tile_validation import image_format
+
+EXPORT_FORMATS = ['webdataset', 'parquet']
+
+
+def parse_args(argv=None):
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Export paired map/satellite tiles as dataset shards.')
+
+    parser.add_argument('--pfile',
+                        type=str,
+                        required=True,
+                        help='Points file, the id of the file. Example: central-belt50.')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level.')
+    parser.add_argument('--cond_api',
+                        type=str,
+                        default='openstreetmap',
+                        help='API of the conditioning images. Example: openstreetmap, ukosgb1888.')
+    parser.add_argument('--target_api',
+                        type=str,
+                        default='worldimagery-clarity',
+                        help='API of the target images. Example: worldimagery-clarity.')
+    parser.add_argument('--prompt',
+                        type=str,
+                        default='convert this openstreetmap into its satellite view',
+                        help='Text prompt stored with every pair.')
+    parser.add_argument('--format',
+                        type=str,
+                        default='webdataset',
+                        choices=EXPORT_FORMATS,
+                        help='Shard format: webdataset (tar) or parquet.')
+    parser.add_argument('--shard_size',
+                        type=int,
+                        default=5000,
+                        help='Number of pairs per shard.')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of parallel shard writers.')
+    parser.add_argument('--source',
+                        type=str,
+                        default='store',
+                        choices=['store', 'files'],
+                        help='Read the tiles from the shared tile store or from the per-dataset tile files '
+                             '(written by download_tiles.py --export_files).')
+    parser.add_argument('--save_root',
+                        type=str,
+                        default='dataset',
+                        help='Root folder of the tiles.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Shared tile store folder. Default: {save_root}/tile_store.')
+
+    # Parse the arguments
+    args = parser.parse_args(argv)
+
+    # HACK: Manually set the arguments
+    args.tiles_path = f'{args.save_root}/tiles_{args.pfile}'
+    args.shards_path = f'{args.save_root}/shards_{args.pfile}'
+    if args.store is None:
+        args.store = f'{args.save_root}/tile_store'
+
+    return args
+
+
+def image_extension(data):
+    return image_format(data) or 'bin'
+
+
+def paired_keys(tiles_path, zoom, cond_api, target_api):
+    # Tiles downloaded for both APIs, sorted so that the shards are reproducible.
+    # Placeholder tiles (see validate_tiles.py) are left out
+    with TileManifest(f'{tiles_path}/manifest.sqlite') as manifest:
+        keys = (manifest.completed(cond_api, zoom, statuses=(STATUS_DONE,))
+                & manifest.completed(target_api, zoom, statuses=(STATUS_DONE,)))
+    return sorted(keys)
+
+
+def available_keys(keys, args, batch_size=1024):
+    # Keys whose tiles can be read for both APIs, so that no shard ends up with fewer
+    # pairs than the others (e.g. tiles removed from the store by validate_tiles.py)
+    if args.source == 'files':
+        return [(x, y) for x, y in keys
+                if os.path.exists(f'{args.tiles_path}/{args.cond_api}/{args.zoom}_{x}_{y}.png')
+                and os.path.exists(f'{args.tiles_path}/{args.target_api}/{args.zoom}_{x}_{y}.png')]
+    available = []
+    with TileStore(args.store) as store:
+        for i in range(0, len(keys), batch_size):
+            batch = keys[i:i + batch_size]
+            stored = (store.lookup(args.cond_api, args.zoom, batch).keys()
+                      & store.lookup(args.target_api, args.zoom, batch).keys())
+            available.extend(key for key in batch if key in stored)
+    return available
+
+
+def read_pairs(keys, args):
+    # Yield (key, conditioning bytes, target bytes) for each tile
+    if args.source == 'store':
+        with TileStore(args.store) as store:
+            for x, y in keys:
+                yield (f'{args.zoom}_{x}_{y}',
+                       store.get(args.cond_api, args.zoom, x, y),
+                       store.get(args.target_api, args.zoom, x, y))
+    else:
+        for x, y in keys:
+            key = f'{args.zoom}_{x}_{y}'
+            with open(f'{args.tiles_path}/{args.cond_api}/{key}.png', 'rb') as f:
+                cond = f.read()
+            with open(f'{args.tiles_path}/{args.target_api}/{key}.png', 'rb') as f:
+                target = f.read()
+            yield key, cond, target
+
+
+def add_tar_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0  # Fixed, so that the shards are reproducible
+    tar.addfile(info, io.BytesIO(data))
+
+
+def write_webdataset_shard(path, pairs, prompt):
+    prompt = prompt.encode('utf-8')
+    count = 0
+    with tarfile.open(f'{path}.part', 'w') as tar:
+        for key, cond, target in pairs:
+            if cond is None or target is None:
+                continue
+            add_tar_member(tar, f'{key}.conditioning_image.{image_extension(cond)}', cond)
+            add_tar_member(tar, f'{key}.image.{image_extension(target)}', target)
+            add_tar_member(tar, f'{key}.txt', prompt)
+            count += 1
+    os.replace(f'{path}.part', path)
+    return count
+
+
+def write_parquet_shard(path, pairs, prompt):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    columns = {'key': [], 'image': [], 'conditioning_image': [], 'text': []}
+    for key, cond, target in pairs:
+        if cond is None or target is None:
+            continue
+        columns['key'].append(key)
+        columns['image'].append(target)
+        columns['conditioning_image'].append(cond)
+        columns['text'].append(prompt)
+    schema = pa.schema([('key', pa.string()), ('image', pa.binary()),
+                        ('conditioning_image', pa.binary()), ('text', pa.string())])
+    pq.write_table(pa.table(columns, schema=schema), f'{path}.part')
+    os.replace(f'{path}.part', path)
+    return len(columns['key'])
+
+
+def write_shard(shard_id, keys, args):
+    # Each writer reads its own tiles, so that shards are written in parallel
+    extension = 'tar' if args.format == 'webdataset' else 'parquet'
+    path = f'{args.shards_path}/{args.pfile}-{shard_id:06d}.{extension}'
+    pairs = read_pairs(keys, args)
+    if args.format == 'webdataset':
+        return write_webdataset_shard(path, pairs, args.prompt)
+    return write_parquet_shard(path, pairs, args.prompt)
+
+
+def main(args=None):
+
+    if args is None:
+        args = parse_args()
+
+    if not os.path.exists(args.shards_path):
+        os.makedirs(args.shards_path)
+
+    # Pair the conditioning and target tiles by tile key
+    keys = paired_keys(args.tiles_path, args.zoom, args.cond_api, args.target_api)
+    available = available_keys(keys, args)
+    if len(available) < len(keys):
+        print(f"{len(keys) - len(available)} pairs left out, their tiles are missing")
+    keys = available
+    shards = [keys[i:i + args.shard_size] for i in range(0, len(keys), args.shard_size)]
+    print(f"Exporting {len(keys)} pairs into {len(shards)} shards")
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(write_shard, i, shard, args) for i, shard in enumerate(shards)]
+        exported = sum(future.result() for future in futures)
+
+    print(f"{exported} pairs exported to {args.shards_path}")
+    return exported
+
+
+if __name__ == '__main__':
+    main()
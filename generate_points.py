@@ -1,13 +1,12 @@
-import geopandas as gpd
-from shapefile_utils import lat_lon_to_epsg, create_rectangle_shapefile, \
-                            intersect_shapefiles, create_polygon, change_lat_with_lon, \
-                            save_folium_map, generate_random_points_within_shapefile_parallel
-import matplotlib.pyplot as plt
+from shapefile_utils import save_folium_map, generate_random_points_within_shapefile_parallel, \
+                            generate_spaced_points_within_shapefile, SAMPLING_METHODS, FOLIUM_MODES, DISTANCE_UNITS
+from region_registry import load_region, load_region_index, load_regions_config, REGIONS_CONFIG
+from crs_utils import transform_points, WGS84
 import os
 import numpy as np
 import argparse
 
-def parse_args():
+def parse_args(argv=None):
     # Initialize the argument parser
     parser = argparse.ArgumentParser(description='Command line arguments.')
 
@@ -20,7 +19,19 @@ def parse_args():
                         type=str,
                         default='sct',
                         required=True,
-                        help='Name of the region. Example: edi, sct, central-belt.')
+                        help='Name of the region in the regions config. Example: edi, sct, central-belt.')
+    parser.add_argument('--regions',
+                        type=str,
+                        default=REGIONS_CONFIG,
+                        help='Regions config file.')
+    parser.add_argument('--simplify',
+                        type=float,
+                        default=None,
+                        help='Simplify the region geometry with this tolerance (in degrees).')
+    parser.add_argument('--grid_index',
+                        type=int,
+                        default=1024,
+                        help='Resolution of the grid index used for rejection sampling, 0 to disable.')
     
     parser.add_argument('--root',
                         type=str,
@@ -30,6 +41,33 @@ def parse_args():
                         type=int,
                         default=42,
                         help='Seed for the random generator.')
+    parser.add_argument('--method',
+                        type=str,
+                        default='rejection',
+                        choices=SAMPLING_METHODS,
+                        help='Sampling method. Example: rejection, triangulation (exact, area-weighted).')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of sampling processes. Default: the number of CPUs. The points do not depend on it.')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=10000,
+                        help='Number of points sampled per task, the same points as stream_pipeline.py for the same value.')
+    parser.add_argument('--min_distance',
+                        type=float,
+                        default=None,
+                        help='Minimum distance between the points (Poisson-disk sampling), in --distance_unit. '
+                             'Example: 300 (m), or 1 (tiles), for at most one point per tile.')
+    parser.add_argument('--distance_unit',
+                        type=str,
+                        default='m',
+                        choices=DISTANCE_UNITS,
+                        help='Unit of --min_distance: metres, or tiles of the --zoom level, measured as max(|dx|, |dy|).')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level of the tiles of --min_distance.')
     parser.add_argument('--plots',
                         action='store_true',
                         default=True,
@@ -42,16 +80,25 @@ def parse_args():
                         action='store_true',
                         default=True,
                         help='Create folium map.')
+    parser.add_argument('--folium_mode',
+                        type=str,
+                        default='fast',
+                        choices=FOLIUM_MODES,
+                        help='Folium rendering mode. Example: fast (single clustered layer), heatmap, circles (one object per point, slow).')
+    parser.add_argument('--folium_max_mb',
+                        type=float,
+                        default=20,
+                        help='Output size budget of the folium map in MB, points are decimated to fit it.')
     parser.add_argument('--epsg',
                         type=str,
                         default='EPSG:4326',
-                        help='EPSG code.')
+                        help='EPSG code of the sampling. Example: EPSG:3035 (equal-area) for points uniform in area. '
+                             'The points are saved in EPSG:4326 (lon, lat).')
 
     # Parse the arguments
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     
     # HACK: Manually set the arguments
-    args.shp_sct_path = f'{args.root}/country_data/scotland.shp'
     args.path_figs = f'{args.root}/results'
     args.coord_path = f'{args.path_figs}/{args.name}{args.npoints}'
     
@@ -59,54 +106,51 @@ def parse_args():
 
 
 
-def main():
+def main(args=None):
     
-    args = parse_args()
+    if args is None:
+        args = parse_args()
     
     # Create directories for figures and results if they dont exist
     if not os.path.exists(args.coord_path):
         os.makedirs(args.coord_path)
         
-    # ----------------- Scotland shapefile ---------------
-    # Read the shapefile for Scotland
-    sct_inland = gpd.read_file(args.shp_sct_path)
+    # Load the region from the regions cache, it is only computed when its definition or sources change
+    final_shapefile = load_region(args.name, load_regions_config(args.regions), args.root,
+                                  simplify=args.simplify, crs=args.epsg)
     
-    if args.name == 'edi':
-        # ----------------- Square (edinburgh) shapefile ---------------
-        lat_lon_min = (-3.30, 55.88) # lat, lon
-        lat_lon_max = (-3.08, 55.99) # lat, lo
-        # Create a rectangle shapefile for Edinburgh area
-        edinburgh_shapefile = create_rectangle_shapefile(lat_lon_min, lat_lon_max, crs=args.epsg)
-
-        # ----------------- Intersection shapefile ---------------
-        # Intersect the two shapefiles into a common CRS
-        final_shapefile = intersect_shapefiles(edinburgh_shapefile, sct_inland, crs="EPSG:4326")
-    elif args.name == 'central-belt':
-        # ----------------- Polygon (central belt) shapefile ---------------
-        # lat_lon_min = lat_lon_to_epsg(55.88, -3.30, epsg=scotland_shapefile.crs)
-        # lat_lon_max = lat_lon_to_epsg(55.99, -3.08, epsg=scotland_shapefile.crs)
-        coordinates = ((55.950010, -2.381500), (56.499314, -2.808075), (56.434390, -3.543699),
-                    (56.151770, -4.070388), (55.918314, -5.010594), (55.405161, -4.679781))
-        coordinates = change_lat_with_lon(coordinates)
-        # Create a polygon shapefile for Central Belt area
-        central_belt_shapefile = create_polygon(coordinates, crs=args.epsg)
-        
-        # ----------------- Intersection shapefile ---------------
-        # Intersect the two shapefiles into a common CRS
-        final_shapefile = intersect_shapefiles(central_belt_shapefile, sct_inland, crs="EPSG:4326")
-    else:
-        final_shapefile = sct_inland
+    # Grid index of the region, so that only the candidates near its boundary need an exact test
+    index = None
+    if args.grid_index and args.method == 'rejection' and args.epsg == 'EPSG:4326':
+        index = load_region_index(args.name, load_regions_config(args.regions), args.root,
+                                  simplify=args.simplify, resolution=args.grid_index)
 
     print("Generating points...")
     # Generate random points within the shapefile, latitude range, and longitude range
-    random_points = generate_random_points_within_shapefile_parallel(final_shapefile, num_points=args.npoints, seed=args.seed)
+    if args.min_distance:
+        # Points at least min_distance apart, the region may hold fewer than npoints of them
+        random_points = generate_spaced_points_within_shapefile(final_shapefile, num_points=args.npoints,
+                                                                seed=args.seed, min_distance=args.min_distance,
+                                                                unit=args.distance_unit, zoom=args.zoom,
+                                                                method=args.method, index=index, crs=args.epsg,
+                                                                chunk_size=args.chunk_size)
+    else:
+        random_points = generate_random_points_within_shapefile_parallel(final_shapefile, num_points=args.npoints,
+                                                                         seed=args.seed, method=args.method, index=index,
+                                                                         num_workers=args.workers,
+                                                                         chunk_size=args.chunk_size)
     print("Points generated")
+    # Points sampled in another system are converted to (lon, lat) in one batched call
+    if args.epsg != WGS84:
+        random_points = transform_points(random_points, args.epsg, WGS84)
+        final_shapefile = final_shapefile.to_crs(WGS84)
     np.save(f'{args.coord_path}/{args.name}{args.npoints}.npy', random_points)
 
     # Print the generated points
     # for point in random_points:
     #     print(f"Latitude: {point[0]}, Longitude: {point[1]}")
 
+    import geopandas as gpd
     lon = [point[0] for point in random_points]
     lat = [point[1] for point in random_points]
     point_geometry = gpd.points_from_xy(lon, lat)
@@ -116,6 +160,7 @@ def main():
     
     if args.plots:
         # Plot the random points
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         ax.axis('off')
         final_shapefile.plot(ax=ax, color='lightgrey', edgecolor='black')
@@ -125,7 +170,8 @@ def main():
             plt.show()
             
     if args.folium:
-        save_folium_map(gdf_points, args.coord_path, f'{args.name}{args.npoints}')
+        save_folium_map(gdf_points, args.coord_path, f'{args.name}{args.npoints}',
+                        mode=args.folium_mode, max_bytes=int(args.folium_max_mb * 1e6))
         
 if __name__=='__main__':
     main()
\ No newline at end of file
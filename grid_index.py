@@ -0,0 +1,108 @@
+import numpy as np
+import shapely
+
+# Classes of the grid cells
+OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+
+def edges_boundary_mask(geometry, x_edges, y_edges):
+    # Mark the cells of a rectilinear grid, given by its increasing x and y edges,
+    # crossed by the boundary of the geometry. The boundary is split into segments
+    # shorter than half a cell, so that the bounding box of each segment
+    # (slightly expanded) covers at most 2x2 cells
+    nx, ny = len(x_edges) - 1, len(y_edges) - 1
+    min_size = min(np.diff(x_edges).min(), np.diff(y_edges).min())
+    eps = 1e-6 * max(np.diff(x_edges).max(), np.diff(y_edges).max())
+    lines = shapely.get_parts(shapely.segmentize(shapely.boundary(geometry), min_size / 2))
+    coords, line = shapely.get_coordinates(lines, return_index=True)
+    same_line = line[1:] == line[:-1]
+    start, end = coords[:-1][same_line], coords[1:][same_line]
+
+    mask = np.zeros((nx, ny), dtype=bool)
+    lower = np.minimum(start, end) - eps
+    upper = np.maximum(start, end) + eps
+    i0 = np.clip(np.searchsorted(x_edges, lower[:, 0], side='right') - 1, 0, nx - 1)
+    i1 = np.clip(np.searchsorted(x_edges, upper[:, 0], side='right') - 1, 0, nx - 1)
+    j0 = np.clip(np.searchsorted(y_edges, lower[:, 1], side='right') - 1, 0, ny - 1)
+    j1 = np.clip(np.searchsorted(y_edges, upper[:, 1], side='right') - 1, 0, ny - 1)
+    for i in (i0, i1):
+        for j in (j0, j1):
+            mask[i, j] = True
+    return mask
+
+
+def boundary_mask(geometry, bounds, resolution):
+    # Boundary cells of a regular resolution x resolution grid over the bounds
+    xmin, ymin, xmax, ymax = bounds
+    return edges_boundary_mask(geometry, np.linspace(xmin, xmax, resolution + 1),
+                               np.linspace(ymin, ymax, resolution + 1))
+
+
+class GridIndex:
+    # Grid over the bounds of a region, where each cell is fully inside, fully
+    # outside or on the boundary of the region. Only the points falling in
+    # boundary cells need an exact point-in-polygon test
+
+    def __init__(self, geometry, bounds, classes):
+        self.geometry = geometry
+        self.bounds = tuple(float(b) for b in bounds)
+        self.classes = classes
+        self.resolution = classes.shape[0]
+        shapely.prepare(self.geometry)
+
+    @classmethod
+    def build(cls, geometry, resolution=1024, base_resolution=16):
+        # Multi-resolution build: the cells crossed by the boundary are found at the
+        # final resolution, and pooled into coarser levels. Starting from a coarse
+        # grid, the cells away from the boundary are classified by testing their
+        # center, and only the boundary cells are split into 2x2 children
+        shapely.prepare(geometry)
+        bounds = geometry.bounds
+        base_resolution = min(base_resolution, resolution)
+        levels = int(np.ceil(np.log2(resolution / base_resolution)))
+        resolution = base_resolution * 2 ** levels
+        fine_mask = boundary_mask(geometry, bounds, resolution)
+
+        classes = np.full((base_resolution, base_resolution), BOUNDARY, dtype=np.uint8)
+        for level in range(levels + 1):
+            level_resolution = base_resolution * 2 ** level
+            if level > 0:
+                classes = classes.repeat(2, axis=0).repeat(2, axis=1)
+            scale = resolution // level_resolution
+            mask = fine_mask.reshape(level_resolution, scale, level_resolution, scale).any(axis=(1, 3))
+
+            # Children of boundary cells that are away from the boundary at this level
+            i, j = np.nonzero((classes == BOUNDARY) & ~mask)
+            x = bounds[0] + (i + 0.5) * (bounds[2] - bounds[0]) / level_resolution
+            y = bounds[1] + (j + 0.5) * (bounds[3] - bounds[1]) / level_resolution
+            classes[i, j] = np.where(shapely.contains_xy(geometry, x, y), INSIDE, OUTSIDE)
+
+        return cls(geometry, bounds, classes)
+
+    def lookup(self, x, y):
+        # Class of the cell of each point, OUTSIDE for the points out of the bounds
+        xmin, ymin, xmax, ymax = self.bounds
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        i = np.floor((x - xmin) / (xmax - xmin) * self.resolution).astype(np.int64)
+        j = np.floor((y - ymin) / (ymax - ymin) * self.resolution).astype(np.int64)
+        valid = (i >= 0) & (i < self.resolution) & (j >= 0) & (j < self.resolution)
+        classes = np.full(x.shape, OUTSIDE, dtype=np.uint8)
+        classes[valid] = self.classes[i[valid], j[valid]]
+        return classes
+
+    def contains_xy(self, x, y):
+        # Same result as shapely.contains_xy(geometry, x, y)
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        classes = self.lookup(x, y)
+        inside = classes == INSIDE
+        boundary = classes == BOUNDARY
+        inside[boundary] = shapely.contains_xy(self.geometry, x[boundary], y[boundary])
+        return inside
+
+    def save(self, path):
+        np.savez(path, bounds=np.array(self.bounds), classes=self.classes)
+
+    @classmethod
+    def load(cls, path, geometry):
+        data = np.load(path)
+        return cls(geometry, data['bounds'], data['classes'])
@@ -0,0 +1,193 @@
+import argparse
+import glob
+import hashlib
+import importlib
+import json
+import os
+import time
+
+# Stages of the pipeline, and the script running each one. Each script has a
+# parse_args(argv) and a main(args), and is only imported when its stage runs,
+# so that e.g. the export does not pay for the imports of the sampling
+STAGES = {
+    'region': 'region_registry',
+    'sample': 'generate_points',
+    'tiles': 'download_tiles',
+    'validate': 'validate_tiles',
+    'export': 'export_dataset',
+}
+
+# Arguments that do not change the outputs of a stage
+VOLATILE_ARGS = {'workers', 'concurrency', 'show', 'metrics_interval', 'metrics_port'}
+
+STATE_PATH = '.mapsat/stages.json'
+
+
+def parse_args(argv=None):
+    # Initialize the argument parser, the arguments after the stage are the ones of its script
+    parser = argparse.ArgumentParser(description='Run a stage of the pipeline, skipping it when its inputs did not change. '
+                                                 'Example: python mapsat.py sample --name central-belt --npoints 1000',
+                                     allow_abbrev=False)
+
+    parser.add_argument('stage',
+                        type=str,
+                        choices=list(STAGES),
+                        help='Stage to run, see python mapsat.py <stage> --help for its arguments.')
+    parser.add_argument('stage_args',
+                        nargs=argparse.REMAINDER,
+                        help='Arguments of the stage.')
+    parser.add_argument('--force',
+                        action='store_true',
+                        default=False,
+                        help='Run the stage even if its inputs did not change.')
+    parser.add_argument('--state',
+                        type=str,
+                        default=STATE_PATH,
+                        help='File where the fingerprints of the completed stages are kept.')
+
+    # Parse the arguments
+    return parser.parse_args(argv)
+
+
+def file_signature(path):
+    # Size and modification time of an input file, None if it does not exist
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def stage_key(stage, args):
+    # Identity of a run of a stage: runs with different keys are tracked separately
+    if stage == 'region':
+        return args.name
+    if stage == 'sample':
+        return f'{args.name}{args.npoints}'
+    if stage == 'tiles':
+        return args.tiles_path
+    if stage == 'validate':
+        return args.store
+    return f'{args.shards_path}-{args.format}'
+
+
+def missing_tiles(args):
+    # Number of tiles of a download not completed in its manifest, for each API: the
+    # failed ones (also the ones re-queued by validate_tiles.py) and the ones never
+    # downloaded. None before the first run
+    manifest_path = f'{args.tiles_path}/manifest.sqlite'
+    point_tiles_path = f'{args.tiles_path}/point_tiles_z{args.zoom}.npz'
+    if not os.path.exists(manifest_path) or not os.path.exists(point_tiles_path):
+        return None
+    from tile_manifest import TileManifest
+    from tile_utils import load_point_tiles, parse_shard, tile_shards
+    tiles = load_point_tiles(point_tiles_path)[0]
+    if args.shard is not None:
+        index, num_shards = parse_shard(args.shard)
+        tiles = tiles[tile_shards(tiles, num_shards, args.shard_block) == index]
+    tiles = set(map(tuple, tiles.tolist()))
+    with TileManifest(manifest_path) as manifest:
+        return {api: len(tiles - manifest.completed(api, args.zoom)) for api in args.apis}
+
+
+def stage_inputs(stage, args):
+    # Signatures of the inputs a stage reads, besides its arguments
+    if stage in ('region', 'sample'):
+        from region_registry import load_regions_config, region_fingerprint
+        regions = load_regions_config(args.regions)
+        if args.name not in regions:
+            return None
+        return {'region': region_fingerprint(args.name, regions, args.root)}
+    if stage == 'tiles':
+        return {'points': file_signature(f'{args.coords_path}/{args.pfile}.npy'), 'missing': missing_tiles(args)}
+    if stage == 'validate':
+        # The stores validated, and the manifests marked. Validating changes them,
+        # so the fingerprint recorded is the one of the validated files
+        paths = [f'{args.store}/{api}.mbtiles' for api in args.apis]
+        paths += sorted(glob.glob(f'{args.save_root}/tiles_*/manifest.sqlite'))
+        return {path: file_signature(path) for path in paths}
+    paths = [f'{args.tiles_path}/manifest.sqlite']
+    if args.source == 'store':
+        paths += [f'{args.store}/{args.cond_api}.mbtiles', f'{args.store}/{args.target_api}.mbtiles']
+    return {path: file_signature(path) for path in paths}
+
+
+def stage_outputs(stage, args):
+    # Files the stage writes: it runs again if any of them is gone
+    if stage == 'sample':
+        return [f'{args.coord_path}/{args.name}{args.npoints}.npy']
+    if stage == 'tiles':
+        return [f'{args.tiles_path}/manifest.sqlite', f'{args.tiles_path}/point_tiles_z{args.zoom}.npz']
+    if stage == 'export':
+        return [args.shards_path]
+    return []
+
+
+def stage_completed(stage, args, result):
+    # Whether a run is complete, so that the stage can be skipped next time
+    if stage == 'tiles':
+        # Failed tiles are only retried by running the stage again. The manifest is the
+        # reference: tiles with a flagged content are failed, but counted as downloaded
+        missing = missing_tiles(args)
+        return missing is not None and not any(missing.values())
+    if stage == 'validate':
+        return not args.dry_run
+    return True
+
+
+def fingerprint(stage, args):
+    # Hash of the arguments of a stage and of its inputs
+    inputs = stage_inputs(stage, args)
+    if inputs is None:
+        return None
+    arguments = {name: value for name, value in vars(args).items() if name not in VOLATILE_ARGS}
+    content = json.dumps({'stage': stage, 'args': arguments, 'inputs': inputs}, sort_keys=True, default=str)
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(f'{path}.part', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f'{path}.part', path)
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+
+    # The arguments of the stage are parsed by its own script
+    module = importlib.import_module(STAGES[args.stage])
+    stage_args = module.parse_args(args.stage_args)
+    key = f'{args.stage}:{stage_key(args.stage, stage_args)}'
+
+    state = load_state(args.state)
+    previous = state.get(key)
+    if not args.force and previous is not None and previous['fingerprint'] == fingerprint(args.stage, stage_args) \
+            and all(os.path.exists(path) for path in stage_outputs(args.stage, stage_args)):
+        print(f"{args.stage}: skipped, unchanged since {previous['time']} (--force to run it again)")
+        return None
+
+    result = module.main(stage_args)
+
+    # The fingerprint is taken after the run, since some stages update their inputs
+    state = load_state(args.state)
+    if stage_completed(args.stage, stage_args, result):
+        state[key] = {'fingerprint': fingerprint(args.stage, stage_args),
+                      'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+    else:
+        state.pop(key, None)
+    save_state(args.state, state)
+
+    return result
+
+
+if __name__ == '__main__':
+    main()
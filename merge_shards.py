@@ -0,0 +1,126 @@
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+
+from tile_manifest import TileManifest
+from tile_store import TileStore
+from tile_utils import unique_tiles, save_point_tiles, tile_shards, shard_path
+
+
+def parse_args():
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Merge the shards of a download into one dataset and check its coverage.')
+
+    parser.add_argument('--pfile',
+                        type=str,
+                        required=True,
+                        help='Points file, the id of the file. Example: central-belt50.')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level.')
+    parser.add_argument('--apis',
+                        type=str,
+                        nargs='+',
+                        default=['worldimagery-clarity', 'openstreetmap'],
+                        help='APIs to merge. Example: worldimagery-clarity, openstreetmap.')
+    parser.add_argument('--shard_block',
+                        type=int,
+                        default=1,
+                        help='The --shard_block of the download, to report the missing tiles of each shard.')
+    parser.add_argument('--root',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Root folder.')
+    parser.add_argument('--save_root',
+                        type=str,
+                        default='dataset',
+                        help='Root folder of the tiles.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Shared tile store folder to merge the shard stores into. Default: {save_root}/tile_store.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # HACK: Manually set the arguments, matching download_tiles.py
+    args.coords_path = f'{args.root}/results/{args.pfile}'
+    args.tiles_path = f'{args.save_root}/tiles_{args.pfile}'
+    if args.store is None:
+        args.store = f'{args.save_root}/tile_store'
+
+    return args
+
+
+def find_shards(tiles_path):
+    # Shard folders of a download, checking that all the N shards are there
+    shards = {}
+    for path in glob.glob(f'{tiles_path}/shard-*-of-*'):
+        match = re.fullmatch(r'shard-(\d+)-of-(\d+)', os.path.basename(path))
+        if match:
+            shards[int(match.group(1))] = int(match.group(2))
+    if not shards:
+        raise FileNotFoundError(f"No shards found in {tiles_path}")
+    num_shards = set(shards.values())
+    if len(num_shards) > 1:
+        raise ValueError(f"Shards of different downloads in {tiles_path}: {sorted(num_shards)} shards")
+    num_shards = num_shards.pop()
+    missing = sorted(set(range(num_shards)) - set(shards))
+    if missing:
+        print(f"Warning: shards {missing} of {num_shards} are missing")
+    return sorted(shards), num_shards
+
+
+def main():
+
+    args = parse_args()
+
+    indices, num_shards = find_shards(args.tiles_path)
+    print(f"Merging {len(indices)} of {num_shards} shards into {args.tiles_path}")
+
+    with TileManifest(f'{args.tiles_path}/manifest.sqlite') as manifest, TileStore(args.store) as store:
+        for index in indices:
+            path = shard_path(args.tiles_path, index, num_shards)
+            manifest.merge(f'{path}/manifest.sqlite')
+            # Shards downloaded into their own store
+            shard_store = f'{path}/tile_store'
+            if os.path.abspath(shard_store) != os.path.abspath(args.store):
+                for api in args.apis:
+                    store.merge(shard_store, api)
+            # Move the tile files of the shard next to the others
+            for api in args.apis:
+                if not os.path.exists(f'{args.tiles_path}/{api}'):
+                    os.makedirs(f'{args.tiles_path}/{api}')
+                for tile_path in glob.glob(f'{path}/{api}/*.png'):
+                    os.replace(tile_path, f'{args.tiles_path}/{api}/{os.path.basename(tile_path)}')
+
+        completed = {api: manifest.completed(api, args.zoom) for api in args.apis}
+
+    # Coverage of the merged dataset: every tile of the points must be downloaded
+    coordinates = np.load(f'{args.coords_path}/{args.pfile}.npy')
+    tiles, point_tile = unique_tiles(coordinates, zoom=args.zoom)
+    save_point_tiles(f'{args.tiles_path}/point_tiles_z{args.zoom}.npz', tiles, point_tile, args.zoom)
+
+    shards = tile_shards(tiles, num_shards, args.shard_block)
+    complete = True
+    for api in args.apis:
+        missing = np.array([tuple(tile) not in completed[api] for tile in tiles.tolist()], dtype=bool)
+        print(f"{api}: {len(tiles) - missing.sum()} of {len(tiles)} tiles "
+              f"({100 * (1 - missing.mean()) if len(tiles) else 100:.2f}%)")
+        if missing.any():
+            complete = False
+            counts = np.bincount(shards[missing], minlength=num_shards)
+            for index in np.nonzero(counts)[0]:
+                print(f"  shard {index}/{num_shards}: {counts[index]} tiles missing, "
+                      f"run download_tiles.py --pfile {args.pfile} --shard {index}/{num_shards} again")
+
+    if complete:
+        print("All the tiles are downloaded")
+
+
+if __name__ == '__main__':
+    main()
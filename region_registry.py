@@ -0,0 +1,177 @@
+import argparse
+import hashlib
+import json
+import os
+
+import shapely
+
+from grid_index import GridIndex
+from shapefile_utils import create_rectangle_shapefile, create_polygon, intersect_shapefiles, \
+                            get_largest_geometry
+
+# Named regions, each one is either read from a shapefile ("source", with an optional
+# attribute "filter" and "largest" geometry), or derived from another "region".
+# Then it is optionally intersected with a "bbox" [lon_min, lat_min, lon_max, lat_max]
+# and/or a "polygon" of [lon, lat] vertices.
+REGIONS_CONFIG = f'{os.path.dirname(os.path.abspath(__file__))}/regions.json'
+EPSG = 'EPSG:4326'
+
+
+def load_regions_config(path=REGIONS_CONFIG):
+    with open(path) as f:
+        return json.load(f)
+
+
+def region_fingerprint(name, regions, root):
+    # Hash of everything the region is computed from: its definition, the
+    # size and modification time of its source shapefile, and its parent region
+    spec = regions[name]
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True).encode())
+    if 'source' in spec:
+        stat = os.stat(f"{root}/{spec['source']}")
+        digest.update(f'{stat.st_size}-{stat.st_mtime_ns}'.encode())
+    if 'region' in spec:
+        digest.update(region_fingerprint(spec['region'], regions, root).encode())
+    return digest.hexdigest()
+
+
+def build_region(name, regions, root, cache_dir):
+    # Compute the region from scratch, as a GeoDataFrame in EPSG:4326
+    import geopandas as gpd
+    spec = regions[name]
+    if 'source' in spec:
+        gdf = gpd.read_file(f"{root}/{spec['source']}")
+        for column, value in spec.get('filter', {}).items():
+            gdf = gdf[gdf[column] == value]
+    else:
+        parent = load_region_geometry(spec['region'], regions, root, cache_dir)
+        gdf = gpd.GeoDataFrame(geometry=[parent], crs=EPSG)
+
+    if spec.get('largest'):
+        gdf = get_largest_geometry(gdf)
+    gdf = gdf.to_crs(EPSG)
+
+    if 'bbox' in spec:
+        bbox = spec['bbox']
+        gdf = intersect_shapefiles(create_rectangle_shapefile(bbox[:2], bbox[2:], crs=EPSG), gdf, crs=EPSG)
+    if 'polygon' in spec:
+        gdf = intersect_shapefiles(create_polygon(spec['polygon'], crs=EPSG), gdf, crs=EPSG)
+
+    return gdf
+
+
+def load_region_geometry(name, regions=None, root=None, cache_dir=None, simplify=None):
+    # Load the geometry of a region from the cache, computing it only when its inputs change.
+    # The geometry is returned prepared, with its spatial index built
+    if regions is None:
+        regions = load_regions_config()
+    if name not in regions:
+        raise ValueError(f"Invalid region provided. Supported regions: {list(regions)}")
+    if root is None:
+        root = os.getcwd()
+    if cache_dir is None:
+        cache_dir = f'{root}/country_data/regions'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    key = region_fingerprint(name, regions, root)[:16]
+    if simplify:
+        key = f'{key}-s{simplify:g}'
+    path = f'{cache_dir}/{name}-{key}.wkb'
+
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            geometry = shapely.from_wkb(f.read())
+    else:
+        geometry = shapely.union_all(build_region(name, regions, root, cache_dir).geometry.values)
+        if simplify:
+            geometry = shapely.simplify(geometry, simplify, preserve_topology=True)
+        with open(f'{path}.part', 'wb') as f:
+            f.write(shapely.to_wkb(geometry))
+        os.replace(f'{path}.part', path)
+
+    shapely.prepare(geometry)
+    return geometry
+
+
+def load_region_index(name, regions=None, root=None, cache_dir=None, simplify=None, resolution=1024):
+    # Grid classification index of a region, built once and cached next to its geometry
+    if regions is None:
+        regions = load_regions_config()
+    if root is None:
+        root = os.getcwd()
+    if cache_dir is None:
+        cache_dir = f'{root}/country_data/regions'
+    geometry = load_region_geometry(name, regions, root, cache_dir, simplify)
+
+    key = region_fingerprint(name, regions, root)[:16]
+    if simplify:
+        key = f'{key}-s{simplify:g}'
+    path = f'{cache_dir}/{name}-{key}-grid{resolution}.npz'
+
+    if os.path.exists(path):
+        return GridIndex.load(path, geometry)
+    index = GridIndex.build(geometry, resolution=resolution)
+    index.save(f'{path}.part.npz')
+    os.replace(f'{path}.part.npz', path)
+    return index
+
+
+def load_region(name, regions=None, root=None, cache_dir=None, simplify=None, crs=EPSG):
+    # Region as a single-row GeoDataFrame, as used by the samplers
+    import geopandas as gpd
+    geometry = load_region_geometry(name, regions, root, cache_dir, simplify)
+    gdf = gpd.GeoDataFrame(geometry=[geometry], crs=EPSG)
+    return gdf if crs == EPSG else gdf.to_crs(crs)
+
+
+def parse_args(argv=None):
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Build a region of the regions config, and its grid index, into the regions cache.')
+
+    parser.add_argument('--name',
+                        type=str,
+                        required=True,
+                        help='Name of the region in the regions config. Example: edi, sct, central-belt.')
+    parser.add_argument('--regions',
+                        type=str,
+                        default=REGIONS_CONFIG,
+                        help='Regions config file.')
+    parser.add_argument('--simplify',
+                        type=float,
+                        default=None,
+                        help='Simplify the region geometry with this tolerance (in degrees).')
+    parser.add_argument('--grid_index',
+                        type=int,
+                        default=1024,
+                        help='Resolution of the grid index used for rejection sampling, 0 to disable.')
+    parser.add_argument('--root',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Root folder.')
+
+    # Parse the arguments
+    return parser.parse_args(argv)
+
+
+def main(args=None):
+
+    if args is None:
+        args = parse_args()
+
+    regions = load_regions_config(args.regions)
+    geometry = load_region_geometry(args.name, regions, args.root, simplify=args.simplify)
+    lon_min, lat_min, lon_max, lat_max = geometry.bounds
+    print(f"{args.name}: {shapely.get_num_coordinates(geometry)} vertices, "
+          f"bounds [{lon_min:.4f}, {lat_min:.4f}, {lon_max:.4f}, {lat_max:.4f}]")
+
+    # Grid index used by generate_points.py, so that the sampling stage finds it built
+    if args.grid_index:
+        load_region_index(args.name, regions, args.root, simplify=args.simplify, resolution=args.grid_index)
+        print(f"{args.name}: grid index of resolution {args.grid_index}")
+
+    return geometry
+
+
+if __name__ == '__main__':
+    main()
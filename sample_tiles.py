@@ -0,0 +1,82 @@
+import numpy as np
+import os
+import argparse
+
+from tile_sampler import tile_coverage, sample_tiles, tile_centers
+from tile_utils import save_point_tiles
+from region_registry import load_region_geometry, load_regions_config, REGIONS_CONFIG
+
+
+def parse_args():
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Sample distinct map tiles covering a region.')
+
+    parser.add_argument('--ntiles',
+                        type=int,
+                        required=True,
+                        help='Number of tiles to sample.')
+    parser.add_argument('--name',
+                        type=str,
+                        default='sct',
+                        required=True,
+                        help='Name of the region in the regions config. Example: edi, sct, central-belt.')
+    parser.add_argument('--regions',
+                        type=str,
+                        default=REGIONS_CONFIG,
+                        help='Regions config file.')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level.')
+    parser.add_argument('--min_coverage',
+                        type=float,
+                        default=0.5,
+                        help='Minimum fraction of the tile covered by the region (land).')
+    parser.add_argument('--root',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Root folder.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42,
+                        help='Seed for the random generator.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # HACK: Manually set the arguments. The points file is named as the ones
+    # of generate_points.py, with a "t" suffix, e.g. central-belt1000t
+    args.pfile = f'{args.name}{args.ntiles}t'
+    args.coord_path = f'{args.root}/results/{args.pfile}'
+
+    return args
+
+
+def main():
+
+    args = parse_args()
+
+    if not os.path.exists(args.coord_path):
+        os.makedirs(args.coord_path)
+
+    geometry = load_region_geometry(args.name, load_regions_config(args.regions), args.root)
+
+    # Coverage of every tile of the region bounds
+    print("Computing tile coverage...")
+    xs, ys, coverage = tile_coverage(geometry, args.zoom)
+    print(f"{coverage.size} candidate tiles, {np.count_nonzero(coverage >= max(args.min_coverage, 1e-9))} "
+          f"with a coverage of at least {args.min_coverage}")
+
+    tiles, tiles_coverage = sample_tiles(xs, ys, coverage, args.ntiles, args.min_coverage, args.seed)
+
+    # Save the tile centers as a points file, so that download_tiles.py can be used as is,
+    # along with the sampled tiles and their coverage
+    np.save(f'{args.coord_path}/{args.pfile}.npy', tile_centers(tiles, args.zoom))
+    np.save(f'{args.coord_path}/{args.pfile}_coverage.npy', tiles_coverage)
+    save_point_tiles(f'{args.coord_path}/{args.pfile}_tiles_z{args.zoom}.npz',
+                     tiles, np.arange(len(tiles)), args.zoom)
+    print(f"{len(tiles)} tiles sampled")
+
+
+if __name__ == '__main__':
+    main()
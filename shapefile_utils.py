@@ -1,13 +1,45 @@
-import geopandas as gpd
-import pyproj
+import hashlib
+import numpy as np
+import shapely
 from shapely.geometry import box, Polygon
-import random
 from tqdm import tqdm
-import folium
-from folium.plugins import MarkerCluster
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from tile_utils import deg2num_array, deg2frac_array, tile_keys, hash_uniform
+from crs_utils import transform_coordinates, WGS84
+from spacing_grid import SpacingGrid
+
+# Sampling methods supported by the point samplers
+SAMPLING_METHODS = ['rejection', 'triangulation']
+
+# Methods supported to split the points into train, val and test
+SPLIT_METHODS = ['checkerboard', 'random', 'tiles']
+SPLIT_NAMES = ['train', 'val', 'test']
+
+# Rendering modes of the folium maps: one folium.Circle per point, a single
+# FastMarkerCluster layer drawn in the browser, or a heatmap binned in python
+FOLIUM_MODES = ['circles', 'fast', 'heatmap']
+# Approximate size in the html of a point of the fast and heatmap layers
+FOLIUM_BYTES_PER_POINT = 24
+
+# Triangulations of the sampled regions, keyed by the hash of their WKB
+TRIANGULATION_CACHE = {}
+
+# Points sampled per task of the parallel sampler
+SAMPLING_CHUNK_SIZE = 10000
+# State of the parallel sampler in each worker process, see init_sampling_worker
+SAMPLING_WORKER = {}
+
+# Units of the minimum distance between points: metres, or tiles of a zoom level. Tiles
+# use the Chebyshev distance max(|dx|, |dy|), so that points 1 tile apart are in distinct tiles
+DISTANCE_UNITS = ['m', 'tiles']
+# The minimum-distance sampler stops when fewer candidates than this are kept, the region is full
+MIN_ACCEPTANCE = 0.01
 
 def create_rectangle_shapefile(lower_left, upper_right, crs='EPSG:4326'):
+    # geopandas and folium are slow to import, and most callers only sample or split
+    # points, so they are only imported by the functions using them
+    import geopandas as gpd
     # Create the rectangular geometry
     geometry = box(lower_left[0], lower_left[1], upper_right[0], upper_right[1])
     
@@ -18,6 +50,7 @@ def change_lat_with_lon(coords):
     return [(coord[1], coord[0]) for coord in coords]
 
 def create_polygon(coords, crs='EPSG:4326'):
+    import geopandas as gpd
     # Create the rectangular geometry
     geometry = Polygon(coords)
     
@@ -25,6 +58,7 @@ def create_polygon(coords, crs='EPSG:4326'):
     return gpd.GeoDataFrame(geometry=[geometry], crs=crs)
 
 def get_largest_geometry(geodf):
+    import geopandas as gpd
     # Calculate the area of each geometry in the GeoDataFrame
     geodf['area'] = geodf.geometry.area
     
@@ -37,6 +71,7 @@ def get_largest_geometry(geodf):
     return gpd.GeoDataFrame(geometry=[largest_geometry], crs=geodf.crs)
 
 def intersect_shapefiles(shapefile1, shapefile2, crs):
+    import geopandas as gpd
     # Convert shapefiles to a common CRS
     shapefile1 = shapefile1.to_crs(crs)
     shapefile2 = shapefile2.to_crs(crs)
@@ -46,119 +81,272 @@ def intersect_shapefiles(shapefile1, shapefile2, crs):
 
 
 def lat_lon_to_epsg(lat, lon, epsg):
-    wgs84 = pyproj.CRS("EPSG:4326")  # WGS84 coordinate system (latitude and longitude)
-    target_crs = pyproj.CRS(epsg)     # Target EPSG coordinate system
+    # Scalars or arrays of latitudes and longitudes, with a cached transformer (see crs_utils.py)
+    return transform_coordinates(lon, lat, WGS84, epsg)
+
+def shapefile_geometry(shapefile):
+    # Merge all the rows of the shapefile into a single prepared geometry,
+    # so that containment can be tested for many points in one call
+    geometry = shapely.union_all(shapefile.geometry.values)
+    shapely.prepare(geometry)
+    return geometry
+
+
+def sample_points_in_geometry(geometry, num_points, rng, bounds=None, batch_size=None, index=None):
+    
+    # Get the bounds of the geometry
+    xmin, ymin, xmax, ymax = geometry.bounds if bounds is None else bounds
+    
+    # Size the candidate blocks from the expected acceptance rate,
+    # so that only a few blocks are needed to fill the quota
+    if batch_size is None:
+        acceptance = geometry.area / max((xmax - xmin) * (ymax - ymin), 1e-12)
+        batch_size = int(min(max(num_points / max(acceptance, 1e-3) * 1.1, 1024), 1_000_000))
     
-    transformer = pyproj.Transformer.from_crs(wgs84, target_crs, always_xy=True)
-    transformed_point = transformer.transform(lon, lat)
+    # Draw candidate blocks and keep the ones inside the geometry until the quota is filled
+    blocks = []
+    count = 0
+    while count < num_points:
+        x = rng.uniform(xmin, xmax, batch_size) # x -> lon
+        y = rng.uniform(ymin, ymax, batch_size) # y -> lat
+        # A grid index gives the same result, testing only the points near the boundary
+        inside = shapely.contains_xy(geometry, x, y) if index is None else index.contains_xy(x, y)
+        blocks.append(np.column_stack((x[inside], y[inside])))
+        count += blocks[-1].shape[0]
     
-    return transformed_point[0], transformed_point[1]
+    return np.concatenate(blocks)[:num_points] if blocks else np.empty((0, 2))
 
-def generate_random_points_within_shapefile(shapefile, num_points, seed):
+
+def triangulate_geometry(geometry):
     
-    # Set the seed for random number generation
-    random.seed(seed)
+    # Reuse the triangulation if this region has already been split
+    key = hashlib.sha1(shapely.to_wkb(geometry)).hexdigest()
+    if key in TRIANGULATION_CACHE:
+        return TRIANGULATION_CACHE[key]
     
-    # Get the bounds of the shapefile
-    xmin, ymin, xmax, ymax = shapefile.total_bounds
+    # Split the region (holes included) into triangles that exactly cover it
+    triangles = shapely.get_parts(shapely.constrained_delaunay_triangles(geometry))
+    # Each triangle ring has 4 coordinates (closed), keep the 3 vertices
+    vertices = shapely.get_coordinates(shapely.get_exterior_ring(triangles)).reshape(-1, 4, 2)[:, :3]
     
-    # Generate random points within the bounds and ranges
-    points = []
-    with tqdm(total=num_points) as pbar:
-        while len(points) < num_points:
-            x = random.uniform(xmin, xmax)
-            y = random.uniform(ymin, ymax)
-            point = (x,y) # x -> lon, y-> lat
-            
-            # Check if the point is within the shapefile
-            is_within = False
-            for _, row in shapefile.iterrows():
-                if row['geometry'].contains(gpd.points_from_xy([x], [y])[0]):
-                    is_within = True
-                    break
-            
-            if is_within:
-                pbar.update(1)
-                points.append(point)
+    # Area of each triangle, accumulated for area-weighted triangle choice
+    ab = vertices[:, 1] - vertices[:, 0]
+    ac = vertices[:, 2] - vertices[:, 0]
+    areas = np.abs(ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0]) / 2
+    cumulative_areas = np.cumsum(areas)
     
-    return points
+    TRIANGULATION_CACHE[key] = (vertices, cumulative_areas)
+    return TRIANGULATION_CACHE[key]
 
 
-def generate_random_points_within_shapefile_parallel(shapefile, num_points, seed):
+def sample_points_in_triangles(triangulation, num_points, rng):
+    vertices, cumulative_areas = triangulation
+    
+    # Choose the triangles with probability proportional to their area
+    idx = np.searchsorted(cumulative_areas, rng.uniform(0, cumulative_areas[-1], num_points), side='right')
+    idx = np.minimum(idx, len(cumulative_areas) - 1)
+    a, b, c = vertices[idx, 0], vertices[idx, 1], vertices[idx, 2]
+    
+    # Barycentric sampling, folding the points of the parallelogram back into the triangle
+    r1 = rng.random(num_points)
+    r2 = rng.random(num_points)
+    outside = r1 + r2 > 1
+    r1[outside] = 1 - r1[outside]
+    r2[outside] = 1 - r2[outside]
+    
+    return a + r1[:, None] * (b - a) + r2[:, None] * (c - a)
+
+
+def sample_points(geometry, num_points, rng, method='rejection', bounds=None, index=None):
+    if method == 'rejection':
+        return sample_points_in_geometry(geometry, num_points, rng, bounds=bounds, index=index)
+    elif method == 'triangulation':
+        return sample_points_in_triangles(triangulate_geometry(geometry), num_points, rng)
+    else:
+        raise ValueError(f"Invalid method provided. Supported methods: {SAMPLING_METHODS}")
+
+
+def generate_random_points_within_shapefile(shapefile, num_points, seed, method='rejection', index=None):
     
     # Set the seed for random number generation
-    random.seed(seed)
-    
-    # Get the bounds of the shapefile
-    xmin, ymin, xmax, ymax = shapefile.total_bounds
-    
-    # Define a worker function for generating random points
-    def generate_points_worker(num_points, xmin, xmax, ymin, ymax, progress_queue, result_queue, seed):
-        # Set the seed for random number generation
-        random.seed(seed)
-        points = []
-        while len(points) < num_points:
-            x = random.uniform(xmin, xmax)
-            y = random.uniform(ymin, ymax)
-            point = (x, y)  # x -> lon, y -> lat
-            
-            # Check if the point is within the shapefile
-            is_within = False
-            for _, row in shapefile.iterrows():
-                if row['geometry'].contains(gpd.points_from_xy([x], [y])[0]):
-                    is_within = True
-                    break
-            
-            if is_within:
-                points.append(point)
-        
-        result_queue.put(points)
-        progress_queue.put(num_points)
-    
-    # Create queues for tracking progress and collecting results
-    progress_queue = multiprocessing.Queue()
-    result_queue = multiprocessing.Queue()
-    
-    # Calculate the number of points for each worker
-    num_workers = multiprocessing.cpu_count()
-    points_per_worker = num_points // num_workers
-    remaining_points = num_points % num_workers
-    
-    # Create and start worker processes
-    processes = []
-    for i in range(num_workers):
-        worker_points = points_per_worker + (1 if i < remaining_points else 0)
-        print("Worker {} will generate {} points".format(i, worker_points))
-        process = multiprocessing.Process(
-            target=generate_points_worker,
-            args=(worker_points, xmin, xmax, ymin, ymax, progress_queue, result_queue, seed + i)
-        )
-        process.start()
-        processes.append(process)
-    
-    # Create a progress bar
-    with tqdm(total=num_points) as pbar:
-        completed_points = 0
-        
-        # Wait for progress updates from worker processes
-        while completed_points < num_points:
-            completed_points += progress_queue.get()
-            pbar.update(completed_points - pbar.n)
-        
-        # Collect results from worker processes
-        points = []
-        for _ in range(num_workers):
-            worker_points = result_queue.get()
-            points.extend(worker_points)
-        
-        # Terminate worker processes
-        for process in processes:
-            process.join()
+    rng = np.random.default_rng(seed)
+    
+    # Get the merged geometry and the bounds of the shapefile
+    geometry = shapefile_geometry(shapefile)
+    bounds = shapefile.total_bounds
+    
+    # Generate random points within the shapefile, as an array of (lon, lat)
+    points = sample_points(geometry, num_points, rng, method=method, bounds=bounds, index=index)
     
     return points
 
 
-def save_folium_map(latlon_pointsGDF, path, name):
+def chunk_rng(seed, chunk):
+    # Independent random stream of a chunk of points: the chunk-th child of SeedSequence(seed)
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(chunk,)))
+
+
+def chunk_sizes(num_points, chunk_size):
+    # Number of points of each chunk, only depends on num_points and chunk_size
+    return [min(chunk_size, num_points - start) for start in range(0, num_points, chunk_size)]
+
+
+def init_sampling_worker(geometry, bounds, method, index, triangulation):
+    # Set the sampling state once per worker process. Shapely does not keep
+    # the prepared state across processes
+    shapely.prepare(geometry)
+    if index is not None:
+        shapely.prepare(index.geometry)
+    SAMPLING_WORKER.update(geometry=geometry, bounds=bounds, method=method, index=index,
+                           triangulation=triangulation)
+
+
+def sample_chunk(task):
+    # Sample a chunk of points in a worker process, task is (seed, chunk, num_points)
+    seed, chunk, num_points = task
+    rng = chunk_rng(seed, chunk)
+    if SAMPLING_WORKER['method'] == 'triangulation':
+        return sample_points_in_triangles(SAMPLING_WORKER['triangulation'], num_points, rng)
+    return sample_points_in_geometry(SAMPLING_WORKER['geometry'], num_points, rng,
+                                     bounds=SAMPLING_WORKER['bounds'], index=SAMPLING_WORKER['index'])
+
+
+def generate_random_points_within_shapefile_parallel(shapefile, num_points, seed, method='rejection', index=None,
+                                                     num_workers=None, chunk_size=SAMPLING_CHUNK_SIZE):
+    
+    if method not in SAMPLING_METHODS:
+        raise ValueError(f"Invalid method provided. Supported methods: {SAMPLING_METHODS}")
+    
+    # Get the merged geometry and the bounds of the shapefile
+    geometry = shapefile_geometry(shapefile)
+    bounds = shapefile.total_bounds
+    
+    # Triangulate once in the main process, and send it to the workers
+    triangulation = triangulate_geometry(geometry) if method == 'triangulation' else None
+    
+    # Small chunks are handed out to the workers as they become free, so that a slow
+    # chunk does not hold back the others. Each chunk has its own random stream, and
+    # the chunks are reassembled in order: the points do not depend on num_workers
+    tasks = [(seed, chunk, size) for chunk, size in enumerate(chunk_sizes(num_points, chunk_size))]
+    points = []
+    with tqdm(total=num_points) as pbar, \
+         ProcessPoolExecutor(max_workers=num_workers or multiprocessing.cpu_count(),
+                             initializer=init_sampling_worker,
+                             initargs=(geometry, bounds, method, index, triangulation)) as executor:
+        for chunk_points in executor.map(sample_chunk, tasks):
+            points.append(chunk_points)
+            pbar.update(len(chunk_points))
+    
+    # Array of shape (num_points, 2), where the columns are (lon, lat)
+    return np.concatenate(points) if points else np.empty((0, 2))
+
+
+def stream_random_points_within_shapefile(shapefile, num_points, seed, method='rejection',
+                                          chunk_size=SAMPLING_CHUNK_SIZE, index=None):
+    
+    # Get the merged geometry and the bounds of the shapefile
+    geometry = shapefile_geometry(shapefile)
+    bounds = shapefile.total_bounds
+    
+    # Yield the points in chunks of (lon, lat) arrays, so that only one chunk is in memory.
+    # The chunks use the random streams of the parallel sampler, so that for the same
+    # chunk_size both give the same points
+    for chunk, size in enumerate(chunk_sizes(num_points, chunk_size)):
+        yield sample_points(geometry, size, chunk_rng(seed, chunk), method=method, bounds=bounds, index=index)
+
+
+def spacing_coordinates(points, crs, unit, center, zoom=17):
+    # Planar coordinates of the (x, y) points of crs in which the minimum distance is measured:
+    # metres of an azimuthal equidistant projection centred on the region (center, as lon, lat),
+    # or the tile coordinates at the zoom level (Web Mercator), whose integer part is the tile
+    if unit == 'm':
+        aeqd = f'+proj=aeqd +lat_0={center[1]} +lon_0={center[0]} +datum=WGS84 +units=m'
+        return transform_coordinates(points[:, 0], points[:, 1], crs, aeqd)
+    elif unit == 'tiles':
+        lon, lat = transform_coordinates(points[:, 0], points[:, 1], crs, WGS84)
+        return deg2frac_array(lat, lon, zoom)
+    else:
+        raise ValueError(f"Invalid unit provided. Supported units: {DISTANCE_UNITS}")
+
+
+def generate_spaced_points_within_shapefile(shapefile, num_points, seed, min_distance, unit='m', zoom=17,
+                                            method='rejection', index=None, crs=WGS84,
+                                            chunk_size=SAMPLING_CHUNK_SIZE):
+    
+    # Get the merged geometry and the bounds of the shapefile, in crs
+    geometry = shapefile_geometry(shapefile)
+    bounds = shapefile.total_bounds
+    xmin, ymin, xmax, ymax = bounds
+    center = transform_coordinates((xmin + xmax) / 2, (ymin + ymax) / 2, crs, WGS84)
+    
+    # Planar bounds of the region, from a lattice over its bounds
+    lattice = np.stack(np.meshgrid(np.linspace(xmin, xmax, 65), np.linspace(ymin, ymax, 65)), axis=-1).reshape(-1, 2)
+    x, y = spacing_coordinates(lattice, crs, unit, center, zoom)
+    margin = 0.01 * max(x.max() - x.min(), y.max() - y.min())
+    grid = SpacingGrid((x.min() - margin, y.min() - margin, x.max() + margin, y.max() + margin), min_distance,
+                       chebyshev=unit == 'tiles')
+    
+    # Dart throwing: chunks of uniform candidates (with the random streams of the other
+    # samplers) are kept when they are at least min_distance away from the points kept
+    # so far, until there are num_points points, or until the region is full
+    points = []
+    count = 0
+    chunk = 0
+    with tqdm(total=num_points) as pbar:
+        while count < num_points:
+            rng = chunk_rng(seed, chunk)
+            candidates = sample_points(geometry, chunk_size, rng, method=method, bounds=bounds, index=index)
+            added = grid.add(*spacing_coordinates(candidates, crs, unit, center, zoom), rng)
+            points.append(candidates[added])
+            count += points[-1].shape[0]
+            pbar.update(min(points[-1].shape[0], pbar.total - pbar.n))
+            chunk += 1
+            if count < num_points and points[-1].shape[0] < MIN_ACCEPTANCE * chunk_size:
+                print(f"Warning: the region is full, only {count} points are at least "
+                      f"{min_distance:g} {unit} apart")
+                break
+    
+    # Array of shape (<= num_points, 2), where the columns are (x, y) in crs
+    return np.concatenate(points)[:num_points] if points else np.empty((0, 2))
+
+
+def decimate_points(lat, lon, max_points, seed=0):
+    # Keep a random subset of at most max_points points
+    if max_points is None or len(lat) <= max_points:
+        return lat, lon
+    keep = np.sort(np.random.default_rng(seed).choice(len(lat), size=max_points, replace=False))
+    return lat[keep], lon[keep]
+
+
+def folium_fast_layer(lat, lon, name, color, max_points=None, show=True):
+    from folium.plugins import FastMarkerCluster
+    # Single clustered layer, the markers are only created by the browser
+    lat, lon = decimate_points(np.asarray(lat), np.asarray(lon), max_points)
+    callback = f"""function (row) {{
+        return L.circleMarker(new L.LatLng(row[0], row[1]),
+                              {{radius: 4, weight: 1, color: '{color}', fill: true, fillColor: '{color}'}});
+    }};"""
+    data = np.column_stack((lat, lon)).round(5).tolist()
+    return FastMarkerCluster(data, callback=callback, name=name, show=show)
+
+
+def folium_heatmap_layer(lat, lon, name, max_points=None, show=True):
+    from folium.plugins import HeatMap
+    # Bin the points into at most max_points cells, and draw the non-empty cells as a heatmap
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    # Cells carry a weight too, so they take more space than a point
+    bins = max(int(np.sqrt(max_points * 3 // 4)), 1) if max_points is not None else 512
+    counts, lat_edges, lon_edges = np.histogram2d(lat, lon, bins=bins)
+    i, j = np.nonzero(counts)
+    lat_centers = (lat_edges[i] + lat_edges[i + 1]) / 2
+    lon_centers = (lon_edges[j] + lon_edges[j + 1]) / 2
+    data = np.column_stack((lat_centers, lon_centers, counts[i, j] / counts.max())).round(5).tolist()
+    return HeatMap(data, name=name, show=show)
+
+
+def save_folium_map(latlon_pointsGDF, path, name, mode='fast', max_bytes=20_000_000):
+    import folium
+    from folium.plugins import MarkerCluster
     
     # Create a folium map centered around the mean coordinates of the points
     center_lat = latlon_pointsGDF['lat'].mean()
@@ -167,6 +355,23 @@ def save_folium_map(latlon_pointsGDF, path, name):
     for layer in ['stamentoner','stamenterrain', 'cartodbpositron', 'cartodbdark_matter', 'stamenwatercolor']:
         folium.TileLayer(layer).add_to(m)
 
+    if mode != 'circles':
+        # Build a single compact layer from the coordinate arrays, decimated to the output size budget
+        lat = latlon_pointsGDF['lat'].to_numpy()
+        lon = latlon_pointsGDF['lon'].to_numpy()
+        max_points = max_bytes // FOLIUM_BYTES_PER_POINT
+        if mode == 'fast':
+            folium_fast_layer(lat, lon, "Locations", "#3186cc", max_points).add_to(m)
+        elif mode == 'heatmap':
+            folium_heatmap_layer(lat, lon, "Density", max_points).add_to(m)
+        else:
+            raise ValueError(f"Invalid mode provided. Supported modes: {FOLIUM_MODES}")
+        
+        # Show controls
+        folium.LayerControl().add_to(m)
+        # Save map
+        m.save(f"{path}/{name}.html")
+        return
 
     feature_group_b = folium.FeatureGroup("Locations blue")
     feature_group_y = folium.FeatureGroup("Locations yellow", show=False)
@@ -217,54 +422,70 @@ def save_folium_map(latlon_pointsGDF, path, name):
     m.save(f"{path}/{name}.html")
 
 
-def create_train_val_test(points, degrees, method, ratios, seed):
-    # Set the seed for random number generation
-    random.seed(seed)
+def split_labels(points, method, degrees=None, ratios=None, seed=0, zoom=17, block_size=1):
+    # Assign each point to train (0), val (1) or test (2), as an array of labels
+    points = np.asarray(points)
+    labels = np.full(len(points), 2, dtype=np.int8)
 
     if method == 'checkerboard':
-        train_points, val_points, test_points = [], [], []
-        for lat, lon in points:
-            # Calculate the grid coordinates based on degrees
-            lat_coord = int(lat / degrees)
-            lon_coord = int(lon / degrees)
-
-            # Assign points to train, val, or test based on grid position
-            if lat_coord % 2 == 0 or lon_coord % 2 == 0:
-                train_points.append((lat, lon))
-            elif lat_coord % 2 == 1 and lon_coord % 4 == 1:
-                val_points.append((lat, lon))
-            else:
-                test_points.append((lat, lon))
-            # else:
-            #     if random.random() < 0.5:
-            #         val_points.append((lat, lon))
-            #     else:
-            #         test_points.append((lat, lon))
-
-        return train_points, val_points, test_points
-
-    elif method == 'random':        
+        # Calculate the grid coordinates based on degrees
+        lat_coord = np.trunc(points[:, 0] / degrees).astype(np.int64)
+        lon_coord = np.trunc(points[:, 1] / degrees).astype(np.int64)
+
+        # Assign points to train, val, or test based on grid position
+        train = (lat_coord % 2 == 0) | (lon_coord % 2 == 0)
+        val = ~train & (lat_coord % 2 == 1) & (lon_coord % 4 == 1)
+        labels[train] = 0
+        labels[val] = 1
+
+    elif method == 'random':
         # Shuffle the points randomly
-        random.shuffle(points)
+        order = np.random.default_rng(seed).permutation(len(points))
 
         # Determine the number of points for each split
-        total_points = len(points)
-        train_size = int(ratios[0] * total_points)
-        val_size = int(ratios[1] * total_points)
+        train_size = int(ratios[0] * len(points))
+        val_size = int(ratios[1] * len(points))
+        labels[order[:train_size]] = 0
+        labels[order[train_size:train_size + val_size]] = 1
+
+    elif method == 'tiles':
+        # Spatial blocks of block_size x block_size tiles at the given zoom, so that
+        # the points of a tile (and of neighbouring tiles) always share a split
+        xtile, ytile = deg2num_array(points[:, 1], points[:, 0], zoom)
+        blocks = tile_keys(xtile // block_size, ytile // block_size)
+
+        # Each block goes to a split with probability given by the ratios,
+        # the same block always goes to the same split for a given seed
+        u = hash_uniform(blocks, seed)
+        labels[u < ratios[0] + ratios[1]] = 1
+        labels[u < ratios[0]] = 0
+
+    else:
+        raise ValueError(f"Invalid method provided. Supported methods: {SPLIT_METHODS}")
 
-        # Split the points into train, val, and test sets
-        train_points = points[:train_size]
-        val_points = points[train_size:train_size + val_size]
-        test_points = points[train_size + val_size:]
+    return labels
 
-        return train_points, val_points, test_points
 
-    else:
-        raise ValueError("Invalid method provided. Supported methods: 'checkerboard', 'random'")
+def create_train_val_test(points, degrees, method, ratios, seed, zoom=17, block_size=1):
+    points = np.asarray(points)
+    labels = split_labels(points, method, degrees=degrees, ratios=ratios, seed=seed,
+                          zoom=zoom, block_size=block_size)
+    
+    train_points, val_points, test_points = (points[labels == i] for i in range(3))
+    return train_points, val_points, test_points
+
+
+def save_split_indices(path, name, labels):
+    # Save the indices of the points of each split, e.g. {path}/{name}_train_idx.npy
+    for i, split in enumerate(SPLIT_NAMES):
+        np.save(f'{path}/{name}_{split}_idx.npy', np.flatnonzero(labels == i))
+
 
 def points_to_gdf(points, epsg):
-    lon = [point[0] for point in points]
-    lat = [point[1] for point in points]
+    import geopandas as gpd
+    points = np.asarray(points).reshape(-1, 2)
+    lon = points[:, 0]
+    lat = points[:, 1]
     point_geometry = gpd.points_from_xy(lon, lat)
     gdf_points = gpd.GeoDataFrame(geometry=point_geometry, crs=epsg)
     gdf_points['lon'] = lon
@@ -272,7 +493,15 @@ def points_to_gdf(points, epsg):
     return gdf_points
 
 
-def folium_group_points(points, name, radius, color, fill=True):
+def folium_group_points(points, name, radius, color, fill=True, mode='circles', max_points=None):
+    import folium
+    if mode == 'fast':
+        return folium_fast_layer(points['lat'].to_numpy(), points['lon'].to_numpy(),
+                                 f'{name}-{color}', color, max_points)
+    elif mode == 'heatmap':
+        return folium_heatmap_layer(points['lat'].to_numpy(), points['lon'].to_numpy(),
+                                    f'{name}-density', max_points)
+    
     feature_group = folium.FeatureGroup(f'{name}-{color}')
     for idx, row in points.iterrows():
         feature_group.add_child(folium.Circle(
@@ -285,7 +514,8 @@ def folium_group_points(points, name, radius, color, fill=True):
     return feature_group
 
 
-def save_folium_map_train_val_test(train_gdf, val_gdf, test_gdf, path, name):
+def save_folium_map_train_val_test(train_gdf, val_gdf, test_gdf, path, name, mode='fast', max_bytes=20_000_000):
+    import folium
     
     # Create a folium map centered around the mean coordinates of the points
     center_lat = train_gdf['lat'].mean()
@@ -295,9 +525,14 @@ def save_folium_map_train_val_test(train_gdf, val_gdf, test_gdf, path, name):
         folium.TileLayer(layer).add_to(m)
 
 
-    train_group = folium_group_points(train_gdf, "Train", 150, "blue")
-    val_group = folium_group_points(val_gdf, "Validation", 150, "red")
-    test_group = folium_group_points(test_gdf, "Test", 150, "green")
+    # Share the output size budget between the splits, proportionally to their size
+    total_points = max(len(train_gdf) + len(val_gdf) + len(test_gdf), 1)
+    max_points = max_bytes // FOLIUM_BYTES_PER_POINT
+    budget = lambda gdf: max(max_points * len(gdf) // total_points, 1)
+
+    train_group = folium_group_points(train_gdf, "Train", 150, "blue", mode=mode, max_points=budget(train_gdf))
+    val_group = folium_group_points(val_gdf, "Validation", 150, "red", mode=mode, max_points=budget(val_gdf))
+    test_group = folium_group_points(test_gdf, "Test", 150, "green", mode=mode, max_points=budget(test_gdf))
 
     m.add_child(train_group)
     m.add_child(val_group)
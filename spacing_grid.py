@@ -0,0 +1,93 @@
+import numpy as np
+
+# Largest grid allowed, in cells (4 bytes each)
+MAX_CELLS = 500_000_000
+
+
+class SpacingGrid:
+    # Spatial hash grid of points at least radius apart, in planar coordinates.
+    # Cells have a side of radius / sqrt(2), so that a cell holds at most one point,
+    # and the points closer than radius to a point are in the 5x5 cells around its
+    # cell: checking a candidate takes a constant number of lookups. With the
+    # Chebyshev distance (max(|dx|, |dy|)), cells have a side of radius, and the
+    # points closer than radius are in the 3x3 cells around it
+
+    def __init__(self, bounds, radius, chebyshev=False):
+        xmin, ymin, xmax, ymax = bounds
+        self.radius = radius
+        self.chebyshev = chebyshev
+        self.size = radius if chebyshev else radius / np.sqrt(2)
+        # Neighbouring cells to check on each side
+        self.reach = 1 if chebyshev else 2
+        # Empty cells of padding on each side, so that the neighbours of a cell are always in the grid
+        self.xmin = xmin - self.reach * self.size
+        self.ymin = ymin - self.reach * self.size
+        self.cols = int((xmax - xmin) / self.size) + 2 * self.reach + 1
+        self.rows = int((ymax - ymin) / self.size) + 2 * self.reach + 1
+        if self.cols * self.rows > MAX_CELLS:
+            raise ValueError(f"The minimum distance is too small for the region: "
+                             f"{self.cols} x {self.rows} cells of size {self.size:g}")
+        # Index of the point of each cell, -1 for the empty ones
+        self.cells = np.full(self.cols * self.rows, -1, dtype=np.int32)
+        self.x = np.empty(1024)
+        self.y = np.empty(1024)
+        self.count = 0
+
+    def cell_coordinates(self, x, y):
+        return (np.floor((x - self.xmin) / self.size).astype(np.int64),
+                np.floor((y - self.ymin) / self.size).astype(np.int64))
+
+    def far(self, x, y, cx, cy):
+        # Mask of the points at least radius away from all the points of the grid
+        far = np.ones(len(x), dtype=bool)
+        reach = self.reach
+        for dy in range(-reach, reach + 1):
+            for dx in range(-reach, reach + 1):
+                # Points in the corner cells of the 5x5 cells are at least radius away
+                if not self.chebyshev and abs(dx) == 2 and abs(dy) == 2:
+                    continue
+                index = self.cells[(cy + dy) * self.cols + cx + dx]
+                near = np.flatnonzero(index >= 0)
+                index = index[near]
+                if self.chebyshev:
+                    close = np.maximum(np.abs(self.x[index] - x[near]), np.abs(self.y[index] - y[near])) < self.radius
+                else:
+                    close = (self.x[index] - x[near]) ** 2 + (self.y[index] - y[near]) ** 2 < self.radius ** 2
+                far[near[close]] = False
+        return far
+
+    def insert(self, x, y, cells):
+        if self.count + len(x) > len(self.x):
+            capacity = max(2 * len(self.x), self.count + len(x))
+            self.x = np.concatenate((self.x[:self.count], np.empty(capacity - self.count)))
+            self.y = np.concatenate((self.y[:self.count], np.empty(capacity - self.count)))
+        self.x[self.count:self.count + len(x)] = x
+        self.y[self.count:self.count + len(y)] = y
+        self.cells[cells] = np.arange(self.count, self.count + len(x))
+        self.count += len(x)
+
+    def add(self, x, y, rng):
+        # Add the candidates which are at least radius away from the points of the grid
+        # and from each other, in the order given. Returns the mask of the added ones
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        cx, cy = self.cell_coordinates(x, y)
+        reach, period = self.reach, self.reach + 1
+        inside = (cx >= reach) & (cx < self.cols - reach) & (cy >= reach) & (cy < self.rows - reach)
+        phase = np.where(inside, cx % period + period * (cy % period), -1)
+        added = np.zeros(len(x), dtype=bool)
+
+        # Cells of the same phase (same column and row modulo reach + 1) are at least
+        # radius apart, so the candidates of a phase are checked against the grid and added
+        # at once: the first candidate of each empty cell. Phases are visited in a random
+        # order, so that none of them is favoured
+        for p in rng.permutation(period * period):
+            candidates = np.flatnonzero(phase == p)
+            cells, first = np.unique(cy[candidates] * self.cols + cx[candidates], return_index=True)
+            candidates = candidates[first]
+            empty = self.cells[cells] < 0
+            candidates, cells = candidates[empty], cells[empty]
+            far = self.far(x[candidates], y[candidates], cx[candidates], cy[candidates])
+            candidates, cells = candidates[far], cells[far]
+            self.insert(x[candidates], y[candidates], cells)
+            added[candidates] = True
+        return added
@@ -0,0 +1,73 @@
+import numpy as np
+import os
+import argparse
+
+from shapefile_utils import split_labels, save_split_indices, SPLIT_METHODS, SPLIT_NAMES
+
+
+def parse_args():
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Split a points file into train, val and test.')
+
+    parser.add_argument('--pfile',
+                        type=str,
+                        required=True,
+                        help='Points file, the id of the file. Example: central-belt50.')
+    parser.add_argument('--method',
+                        type=str,
+                        default='tiles',
+                        choices=SPLIT_METHODS,
+                        help='Split method. Example: tiles (spatial blocks of tiles), checkerboard, random.')
+    parser.add_argument('--ratios',
+                        type=float,
+                        nargs=3,
+                        default=[0.8, 0.1, 0.1],
+                        help='Train, val and test ratios (random and tiles methods).')
+    parser.add_argument('--degrees',
+                        type=float,
+                        default=0.1,
+                        help='Size of the cells in degrees (checkerboard method).')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level of the tiles (tiles method).')
+    parser.add_argument('--block_size',
+                        type=int,
+                        default=16,
+                        help='Size of the spatial blocks in tiles (tiles method).')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42,
+                        help='Seed for the random generator.')
+    parser.add_argument('--root',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Root folder.')
+
+    # Parse the arguments
+    args = parser.parse_args()
+
+    # HACK: Manually set the arguments
+    args.coords_path = f'{args.root}/results/{args.pfile}'
+
+    return args
+
+
+def main():
+
+    args = parse_args()
+
+    # Load the coordinates
+    coordinates = np.load(f'{args.coords_path}/{args.pfile}.npy')
+
+    labels = split_labels(coordinates, args.method, degrees=args.degrees, ratios=args.ratios,
+                          seed=args.seed, zoom=args.zoom, block_size=args.block_size)
+
+    # Save the split indices next to the points file
+    save_split_indices(args.coords_path, args.pfile, labels)
+    for i, split in enumerate(SPLIT_NAMES):
+        print(f"{split}: {np.count_nonzero(labels == i)} points")
+
+
+if __name__ == '__main__':
+    main()
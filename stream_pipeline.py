@@ -0,0 +1,210 @@
+import numpy as np
+import os
+import argparse
+import asyncio
+import threading
+
+from shapefile_utils import stream_random_points_within_shapefile, SAMPLING_METHODS
+from tile_utils import stream_unique_tiles, save_point_tiles
+from region_registry import load_region, load_region_index, load_regions_config, REGIONS_CONFIG
+from download_tiles import download
+from crs_utils import transform_points, WGS84
+
+
+def parse_args(argv=None):
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Sample points and download their tiles in a single streaming pass.')
+
+    parser.add_argument('--npoints',
+                        type=int,
+                        required=True,
+                        help='Number of points to generate.')
+    parser.add_argument('--name',
+                        type=str,
+                        default='sct',
+                        required=True,
+                        help='Name of the region in the regions config. Example: edi, sct, central-belt.')
+    parser.add_argument('--regions',
+                        type=str,
+                        default=REGIONS_CONFIG,
+                        help='Regions config file.')
+    parser.add_argument('--simplify',
+                        type=float,
+                        default=None,
+                        help='Simplify the region geometry with this tolerance (in degrees).')
+    parser.add_argument('--grid_index',
+                        type=int,
+                        default=1024,
+                        help='Resolution of the grid index used for rejection sampling, 0 to disable.')
+    parser.add_argument('--root',
+                        type=str,
+                        default=os.getcwd(),
+                        help='Root folder.')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=42,
+                        help='Seed for the random generator.')
+    parser.add_argument('--method',
+                        type=str,
+                        default='rejection',
+                        choices=SAMPLING_METHODS,
+                        help='Sampling method. Example: rejection, triangulation (exact, area-weighted).')
+    parser.add_argument('--epsg',
+                        type=str,
+                        default='EPSG:4326',
+                        help='EPSG code of the sampling. Example: EPSG:3035 (equal-area) for points uniform in area. '
+                             'The points are saved in EPSG:4326 (lon, lat).')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=10000,
+                        help='Number of points sampled at a time.')
+    parser.add_argument('--zoom',
+                        type=int,
+                        default=17,
+                        help='Zoom level.')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=None,
+                        help='Maximum number of requests in flight per API. Default: the limit of each API in APIS.')
+    parser.add_argument('--apis',
+                        type=str,
+                        nargs='+',
+                        default=['worldimagery-clarity', 'openstreetmap'],
+                        help='APIs to use. Example: worldimagery-clarity, openstreetmap.')
+    parser.add_argument('--save_root',
+                        type=str,
+                        default='dataset',
+                        help='Root folder to save the tiles.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Shared tile store folder. Default: {save_root}/tile_store.')
+    parser.add_argument('--export_files',
+                        action='store_true',
+                        default=False,
+                        help='Also write the tiles as per-dataset tile files, besides the shared store.')
+    parser.add_argument('--metrics_interval',
+                        type=float,
+                        default=10.0,
+                        help='Seconds between the download metrics reports.')
+    parser.add_argument('--metrics_port',
+                        type=int,
+                        default=None,
+                        help='Serve the download metrics in the Prometheus text format on this port.')
+
+    # Parse the arguments
+    args = parser.parse_args(argv)
+
+    # HACK: Manually set the arguments, matching generate_points.py and download_tiles.py
+    args.pfile = f'{args.name}{args.npoints}'
+    args.coord_path = f'{args.root}/results/{args.pfile}'
+    args.tiles_path = f'{args.save_root}/tiles_{args.pfile}'
+    if args.store is None:
+        args.store = f'{args.save_root}/tile_store'
+
+    return args
+
+
+async def iterate_in_thread(iterable, maxsize=4):
+    # Iterate over iterable in a thread, yielding its items to the event loop through
+    # a bounded queue: the thread runs at most maxsize items ahead, and the loop (the
+    # downloads, the metrics) is not blocked while an item is produced
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stopped.is_set():
+                    return
+                asyncio.run_coroutine_threadsafe(queue.put((item, None)), loop).result()
+        except Exception as e:
+            asyncio.run_coroutine_threadsafe(queue.put((done, e)), loop).result()
+        else:
+            asyncio.run_coroutine_threadsafe(queue.put((done, None)), loop).result()
+
+    producer = loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+        await producer
+    finally:
+        # When the downloads stop early, let the thread finish its last item and return
+        stopped.set()
+        while not queue.empty():
+            queue.get_nowait()
+
+
+def main(args=None):
+
+    if args is None:
+        args = parse_args()
+
+    for path in [args.coord_path, args.tiles_path]:
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    final_shapefile = load_region(args.name, load_regions_config(args.regions), args.root,
+                                  simplify=args.simplify, crs=args.epsg)
+    
+    # Grid index of the region, so that only the candidates near its boundary need an exact test
+    index = None
+    if args.grid_index and args.method == 'rejection' and args.epsg == 'EPSG:4326':
+        index = load_region_index(args.name, load_regions_config(args.regions), args.root,
+                                  simplify=args.simplify, resolution=args.grid_index)
+
+    # The points and their tiles are written to disk as they are sampled, in the same
+    # .npy format as generate_points.py. The memmaps are kept in a dict, so that they
+    # can be released at the end without deleting names used by chunk_tiles
+    point_tile_path = f'{args.tiles_path}/point_tile_z{args.zoom}.part.npy'
+    outputs = {
+        'points': np.lib.format.open_memmap(f'{args.coord_path}/{args.pfile}.npy', mode='w+',
+                                            dtype=np.float64, shape=(args.npoints, 2)),
+        'point_tile': np.lib.format.open_memmap(point_tile_path, mode='w+', dtype=np.int64, shape=(args.npoints,)),
+    }
+    tile_index = {}
+
+    def chunk_tiles():
+        # Sampled points flow through tile deduplication into the download queues, in a
+        # thread. The queues are bounded, so sampling only runs ahead of the downloads by
+        # a few chunks, and the downloads keep going while a chunk is sampled
+        offset = 0
+        chunks = stream_random_points_within_shapefile(final_shapefile, args.npoints, args.seed,
+                                                       method=args.method, chunk_size=args.chunk_size,
+                                                       index=index)
+        if args.epsg != WGS84:
+            # Points sampled in another system are converted to (lon, lat)
+            chunks = (transform_points(chunk, args.epsg, WGS84) for chunk in chunks)
+        for chunk, chunk_point_tile, new_tiles in stream_unique_tiles(chunks, args.zoom, tile_index):
+            outputs['points'][offset:offset + len(chunk)] = chunk
+            outputs['point_tile'][offset:offset + len(chunk)] = chunk_point_tile
+            offset += len(chunk)
+            yield new_tiles
+        print(f"{args.npoints} points sampled, falling in {len(tile_index)} unique tiles")
+
+    async def tiles():
+        async for new_tiles in iterate_in_thread(chunk_tiles()):
+            for tile in new_tiles:
+                yield tile
+
+    download(tiles(), args.apis, args.zoom, args.tiles_path, args.store,
+             export_files=args.export_files, concurrency=args.concurrency,
+             metrics_interval=args.metrics_interval, metrics_port=args.metrics_port)
+
+    # Save the points and the point -> tile mapping, kept on disk while sampling
+    outputs['points'].flush()
+    save_point_tiles(f'{args.tiles_path}/point_tiles_z{args.zoom}.npz',
+                     np.array(list(tile_index), dtype=np.int64).reshape(-1, 2), outputs['point_tile'], args.zoom)
+    outputs.clear()
+    os.remove(point_tile_path)
+
+
+if __name__ == '__main__':
+    main()
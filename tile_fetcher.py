@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import os
+import random
+import time
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+# A single tile to fetch from a provider of the APIS table
+TileJob = namedtuple('TileJob', ['api', 'zoom', 'x', 'y', 'path'])
+
+USER_AGENT = 'map-sat-tile-downloader'
+CHUNK_SIZE = 64 * 1024
+
+# Limits used for the providers that do not set their own in the APIS table.
+# rate: requests per second (token bucket), burst: bucket size,
+# concurrency: maximum requests in flight, adapted between min_concurrency and it,
+# max_retries / retry_delay / max_retry_delay: jittered exponential backoff.
+DEFAULT_LIMITS = {
+    'rate': 100.0,
+    'burst': 100,
+    'concurrency': 64,
+    'min_concurrency': 1,
+    'max_retries': 5,
+    'retry_delay': 2.0,
+    'max_retry_delay': 120.0,
+}
+
+# HTTP statuses meaning the provider is overloaded or throttling us
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def format_string(url, x, y, zoom):
+    substituted_string = url.replace('{x}', str(x))
+    substituted_string = substituted_string.replace('{y}', str(y))
+    substituted_string = substituted_string.replace('{z}', str(zoom))
+    return substituted_string
+
+
+def provider_config(entry):
+    # An APIS entry is either a url template, or a dict with the url and its limits
+    if isinstance(entry, str):
+        entry = {'url': entry}
+    return {**DEFAULT_LIMITS, **entry}
+
+
+def parse_retry_after(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class ThrottledError(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ProviderLimiter:
+    # Token bucket plus an AIMD concurrency limit for a single provider:
+    # the limit grows by one request per window of successes, and is
+    # halved when the provider throttles us (429/5xx), pausing it for Retry-After.
+    # The limit is halved once per congestion event: throttles of requests
+    # started before the last decrease were sent at the old limit, and are ignored
+
+    def __init__(self, config):
+        self.rate = float(config['rate'])
+        self.burst = float(config['burst'])
+        self.max_concurrency = int(config['concurrency'])
+        self.min_concurrency = int(config['min_concurrency'])
+        self.limit = float(self.max_concurrency)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        # Wait for a free slot under the current concurrency limit,
+        # returns the start time of the request, to give back to release
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        # Wait for a token, and for the end of any Retry-After pause
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = self.paused_until - now
+            if wait <= 0:
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return now
+                wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    async def release(self, throttled=False, retry_after=None, started=None):
+        async with self.condition:
+            self.active -= 1
+            if throttled:
+                # Multiplicative decrease, once per congestion event
+                if started is None or started >= self.last_decrease:
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self.last_decrease = time.monotonic()
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                # Additive increase
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def backoff_delay(retries, config):
+    # Full-jitter exponential backoff
+    return random.uniform(0, min(config['max_retry_delay'], config['retry_delay'] * 2 ** retries))
+
+
+async def fetch_tile(session, url, tile_path, limiter, config, metrics=None):
+    # metrics is the ProviderMetrics of the provider, observing every request
+    # Stream the body to a temporary file, so that a failed
+    # download never leaves a truncated tile behind
+    part_path = f'{tile_path}.part'
+    retries = 0
+    while retries < config['max_retries']:
+        start = await limiter.acquire()
+        throttled, retry_after = False, None
+        status, size = None, 0
+        try:
+            async with session.get(url) as response:
+                status = response.status
+                if response.status in THROTTLE_STATUSES:
+                    raise ThrottledError(response.status, parse_retry_after(response.headers.get('Retry-After')))
+                response.raise_for_status()
+                digest = hashlib.sha256()
+                with open(part_path, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        f.write(chunk)
+                        size += len(chunk)
+                        digest.update(chunk)
+                os.replace(part_path, tile_path)
+                return size, digest.hexdigest()  # Download successful, exit the function
+        except ThrottledError as e:
+            print(f"Download throttled: {url} {e}")
+            throttled, retry_after = True, e.retry_after
+        except aiohttp.ClientResponseError as e:
+            # Other HTTP errors (e.g. 404) will not succeed on a retry
+            print(f"Download failed: {url} {e!r}")
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            print(f"Download failed: {url} {e!r}")
+            status = type(e).__name__
+        finally:
+            # Failed or cancelled downloads leave no partial file behind
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            await limiter.release(throttled=throttled, retry_after=retry_after, started=start)
+            if metrics is not None:
+                metrics.observe_request(status, time.monotonic() - start, size)
+        retries += 1
+        if retries < config['max_retries']:
+            if metrics is not None:
+                metrics.observe_retry()
+            retry_delay = retry_after if retry_after is not None else backoff_delay(retries, config)
+            print(f"Retrying in {retry_delay:.1f} seconds...")
+            await asyncio.sleep(retry_delay)
+        else:
+            print("Max retries reached, giving up.")
+    return None
+
+
+async def fetch_tiles(jobs, apis, concurrency=None, timeout=60, queue_size=4096, on_result=None, metrics=None,
+                      max_backlog=262144):
+
+    # Every provider gets its own limits, connection pool, queue and workers,
+    # so that a slow provider does not hold back a fast one
+    configs, limiters, sessions, queues, workers = {}, {}, {}, {}, []
+
+    # Count the downloaded and failed tiles for each provider
+    results = {}
+
+    # Set when a worker takes a job from its queue, to wake up the producer
+    taken = asyncio.Event()
+
+    async def worker(api):
+        queue = queues[api]
+        while True:
+            job = await queue.get()
+            taken.set()
+            if job is None:
+                return
+            url = format_string(configs[api]['url'], job.x, job.y, job.zoom)
+            provider_metrics = metrics.provider(api) if metrics is not None else None
+            result = await fetch_tile(sessions[api], url, job.path, limiters[api], configs[api], provider_metrics)
+            counts = results.setdefault(api, {'downloaded': 0, 'failed': 0})
+            counts['failed' if result is None else 'downloaded'] += 1
+            if provider_metrics is not None:
+                provider_metrics.observe_result(result is not None, limiters[api].limit)
+            # Result is (size, sha256) of the tile, or None if it failed
+            if on_result is not None:
+                on_result(job, result)
+
+    def start_provider(api):
+        config = provider_config(apis[api])
+        if concurrency is not None:
+            config['concurrency'] = concurrency
+        configs[api] = config
+        limiters[api] = ProviderLimiter(config)
+        sessions[api] = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=config['concurrency']),
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers={'User-Agent': USER_AGENT},
+        )
+        queues[api] = asyncio.Queue()
+        workers.extend(asyncio.create_task(worker(api)) for _ in range(config['concurrency']))
+
+    # Periodic metrics reports (see download_metrics.DownloadMetrics)
+    if metrics is not None:
+        await metrics.start()
+
+    def backpressure():
+        # Jobs are produced lazily by a generator, interleaved between the providers. The
+        # producer only waits when every provider has queue_size jobs queued, so that a
+        # throttled provider does not leave the others idle: its queue grows instead, up
+        # to max_backlog jobs, which keeps memory bounded
+        return (all(queue.qsize() >= queue_size for queue in queues.values())
+                or any(queue.qsize() >= max_backlog for queue in queues.values()))
+
+    async def wait_for_workers():
+        # Wait for a worker to take a job. Workers only return once the jobs are
+        # done, so a finished worker here died: its error is raised, instead of
+        # waiting forever for the jobs of its queue to be taken
+        taken.clear()
+        waiter = asyncio.ensure_future(taken.wait())
+        done, _ = await asyncio.wait([waiter, *workers], return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        for task in done:
+            if task is not waiter:
+                task.result()
+                raise RuntimeError('A download worker stopped before the end of the jobs')
+
+    async def submit(job):
+        if job.api not in queues:
+            start_provider(job.api)
+        queues[job.api].put_nowait(job)
+        while backpressure():
+            await wait_for_workers()
+
+    try:
+        # jobs is an iterable, or an async iterable, e.g. fed by a thread producing them
+        if hasattr(jobs, '__aiter__'):
+            async for job in jobs:
+                await submit(job)
+        else:
+            for job in jobs:
+                await submit(job)
+        for api, queue in queues.items():
+            for _ in range(configs[api]['concurrency']):
+                queue.put_nowait(None)
+        await asyncio.gather(*workers)
+    finally:
+        for worker_task in workers:
+            worker_task.cancel()
+        for session in sessions.values():
+            await session.close()
+        if metrics is not None:
+            await metrics.stop()
+
+    return results
+
+
+def download_tiles(jobs, apis, concurrency=None, timeout=60, queue_size=4096, on_result=None, metrics=None,
+                   max_backlog=262144):
+    # Synchronous entry point for the scripts
+    return asyncio.run(fetch_tiles(jobs, apis, concurrency=concurrency, timeout=timeout,
+                                   queue_size=queue_size, on_result=on_result, metrics=metrics,
+                                   max_backlog=max_backlog))
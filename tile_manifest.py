@@ -0,0 +1,103 @@
+import sqlite3
+import time
+
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+# Downloaded, but a placeholder (e.g. "no data") tile, see tile_validation.py
+STATUS_BLANK = 'blank'
+
+
+class TileManifest:
+    # Persistent index of the downloaded tiles, stored as SQLite next to the tiles
+
+    def __init__(self, path, commit_every=1000):
+        self.path = path
+        self.commit_every = commit_every
+        self.pending = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                api TEXT NOT NULL,
+                zoom INTEGER NOT NULL,
+                x INTEGER NOT NULL,
+                y INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                size INTEGER,
+                sha256 TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (api, zoom, x, y)
+            )
+        """)
+        self.conn.commit()
+
+    def completed(self, api, zoom, statuses=(STATUS_DONE, STATUS_BLANK)):
+        # Set of the (x, y) tiles already downloaded, for O(1) lookups
+        rows = self.conn.execute(f'SELECT x, y FROM tiles WHERE api = ? AND zoom = ? '
+                                 f'AND status IN ({",".join("?" * len(statuses))})',
+                                 (api, zoom, *statuses))
+        return set(rows)
+
+    def record(self, api, zoom, x, y, status, size=None, sha256=None):
+        self.conn.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (api, zoom, x, y, status, size, sha256, time.time()))
+        # Commit in batches, a crash loses at most the last batch
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def record_result(self, job, result):
+        # Callback for the tile fetcher, result is (size, sha256) or None
+        if result is None:
+            self.record(job.api, job.zoom, job.x, job.y, STATUS_FAILED)
+        else:
+            self.record(job.api, job.zoom, job.x, job.y, STATUS_DONE, *result)
+
+    def mark(self, api, sha256s, status, from_statuses=(STATUS_DONE, STATUS_BLANK)):
+        # Change the status of the tiles of an API with the given contents,
+        # returns the number of changed tiles
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS marked (sha256 TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM marked')
+        self.conn.executemany('INSERT OR IGNORE INTO marked VALUES (?)', [(sha256,) for sha256 in sha256s])
+        changed = self.conn.execute(f'UPDATE tiles SET status = ?, updated = ? WHERE api = ? '
+                                    f'AND sha256 IN (SELECT sha256 FROM marked) '
+                                    f'AND status IN ({",".join("?" * len(from_statuses))})',
+                                    (status, time.time(), api, *from_statuses)).rowcount
+        self.commit()
+        return changed
+
+    def merge(self, path):
+        # Add the tiles of another manifest (e.g. of a shard), a failed tile
+        # never replaces a completed one
+        self.commit()
+        self.conn.execute('ATTACH DATABASE ? AS other', (path,))
+        try:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO tiles SELECT * FROM other.tiles AS new
+                WHERE NOT (new.status = ? AND EXISTS (
+                    SELECT 1 FROM main.tiles AS old
+                    WHERE old.api = new.api AND old.zoom = new.zoom AND old.x = new.x AND old.y = new.y
+                    AND old.status != ?))
+            """, (STATUS_FAILED, STATUS_FAILED))
+            self.conn.commit()
+        finally:
+            self.conn.execute('DETACH DATABASE other')
+
+    def counts(self):
+        rows = self.conn.execute('SELECT api, status, COUNT(*) FROM tiles GROUP BY api, status')
+        return {(api, status): count for api, status, count in rows}
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
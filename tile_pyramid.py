@@ -0,0 +1,198 @@
+import hashlib
+import io
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from tile_store import TileStore
+from tile_utils import deg2frac_array
+from tile_validation import image_format
+
+TILE_SIZE = 256
+
+
+def fingerprint(tile_ids):
+    # Fingerprint of the input tiles of a derived image, None for the missing ones
+    return hashlib.sha1('|'.join(tile_id or '' for tile_id in tile_ids).encode()).hexdigest()
+
+
+def encode(image, kind):
+    # Keep the format of the source tiles: lossless for the maps, JPEG for the imagery
+    buffer = io.BytesIO()
+    if kind == 'jpg':
+        image.save(buffer, 'JPEG', quality=90)
+    else:
+        image.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+class TileReader:
+    # Reads and decodes the tiles of a provider from the store, keeping the decoded
+    # tiles of a batch, since neighbouring outputs share their input tiles (and
+    # placeholder tiles are shared by many)
+
+    def __init__(self, store_root, api):
+        # Read-only, so that the workers never wait for the write lock of the main process
+        self.store = TileStore(store_root, read_only=True)
+        self.api = api
+        self.decoded = {}
+        self.kind = None
+
+    def tile(self, tile_id):
+        if tile_id not in self.decoded:
+            data = self.store.get_image(self.api, tile_id)
+            if self.kind is None:
+                self.kind = image_format(data)
+            self.decoded[tile_id] = Image.open(io.BytesIO(data)).convert('RGB')
+        return self.decoded[tile_id]
+
+    def mosaic(self, tile_ids, n):
+        # n x n mosaic of the tiles, given row by row, the missing ones are black
+        mosaic = Image.new('RGB', (n * TILE_SIZE, n * TILE_SIZE))
+        for k, tile_id in enumerate(tile_ids):
+            if tile_id is not None:
+                mosaic.paste(self.tile(tile_id).resize((TILE_SIZE, TILE_SIZE)),
+                             ((k % n) * TILE_SIZE, (k // n) * TILE_SIZE))
+        return mosaic
+
+    def close(self):
+        self.store.close()
+
+
+def children(x, y):
+    # The 2x2 tiles of the next zoom level covering a tile, row by row
+    return [(2 * x, 2 * y), (2 * x + 1, 2 * y), (2 * x, 2 * y + 1), (2 * x + 1, 2 * y + 1)]
+
+
+def build_parents(store_root, api, parents):
+    # Worker: downsample the 2x2 children of each parent, given as (x, y, child tile_ids)
+    reader = TileReader(store_root, api)
+    try:
+        results = []
+        for x, y, tile_ids in parents:
+            image = reader.mosaic(tile_ids, 2).resize((TILE_SIZE, TILE_SIZE), Image.BOX)
+            results.append((x, y, encode(image, reader.kind)))
+        return results
+    finally:
+        reader.close()
+
+
+def build_level(store_root, api, zoom, min_children=4, workers=None, batch_size=256):
+    # Build the tiles of zoom - 1 from the tiles of zoom in the store. Parents are
+    # only rebuilt when the fingerprint of their children changed, and tiles
+    # downloaded from the provider at zoom - 1 are never replaced
+    with TileStore(store_root) as store:
+        tile_ids = store.tile_ids(api, zoom)
+        existing = store.tile_ids(api, zoom - 1)
+        derived = store.derived(api, zoom - 1)
+
+    todo = []
+    for x, y in sorted({(x // 2, y // 2) for x, y in tile_ids}):
+        child_ids = [tile_ids.get(child) for child in children(x, y)]
+        if sum(tile_id is not None for tile_id in child_ids) < min_children:
+            continue
+        if (x, y) in existing and (x, y) not in derived:
+            continue
+        sources = fingerprint(child_ids)
+        if derived.get((x, y)) == sources:
+            continue
+        todo.append((x, y, child_ids, sources))
+
+    # Spatially sorted batches, so that each worker decodes each shared tile once
+    sources = {(x, y): s for x, y, _, s in todo}
+    batches = [[(x, y, ids) for x, y, ids, _ in todo[i:i + batch_size]] for i in range(0, len(todo), batch_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor, TileStore(store_root) as store:
+        futures = [executor.submit(build_parents, store_root, api, batch) for batch in batches]
+        for future in futures:
+            for x, y, data in future.result():
+                store.put_derived(api, zoom - 1, x, y, data, sources[(x, y)])
+            # Commit the tiles of each batch, so that the write lock is never held for long
+            store.commit(api)
+    return len(todo)
+
+
+def mosaic_windows(coordinates, zoom, n):
+    # Window of n x n tiles around each (lon, lat) point, given by its top-left tile:
+    # the window whose center is the closest to the point. Neighbouring points share
+    # their windows. Returns the unique windows (M, 2) and the window of each point
+    xtile, ytile = deg2frac_array(coordinates[:, 1], coordinates[:, 0], zoom)
+    x0 = np.floor(xtile - n / 2 + 0.5).astype(np.int64)
+    y0 = np.floor(ytile - n / 2 + 0.5).astype(np.int64)
+    windows, point_window = np.unique(np.column_stack((x0, y0)), axis=0, return_inverse=True)
+    return windows, point_window.reshape(-1)
+
+
+def window_tiles(x0, y0, n):
+    return [(x0 + i, y0 + j) for j in range(n) for i in range(n)]
+
+
+def build_mosaics(store_root, api, mosaics, n, path):
+    # Worker: assemble and save each mosaic, given as (name, tile_ids)
+    reader = TileReader(store_root, api)
+    try:
+        for name, tile_ids in mosaics:
+            data = encode(reader.mosaic(tile_ids, n), reader.kind)
+            file_path = f'{path}/{name}.{reader.kind or "png"}'
+            with open(f'{file_path}.part', 'wb') as f:
+                f.write(data)
+            os.replace(f'{file_path}.part', file_path)
+        return len(mosaics)
+    finally:
+        reader.close()
+
+
+class MosaicIndex:
+    # Fingerprints of the input tiles of the mosaics saved in a folder
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(f'{path}/mosaics.sqlite')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS mosaics (name TEXT PRIMARY KEY, sources TEXT)')
+        self.conn.commit()
+
+    def sources(self):
+        return dict(self.conn.execute('SELECT name, sources FROM mosaics'))
+
+    def update(self, sources):
+        self.conn.executemany('INSERT OR REPLACE INTO mosaics VALUES (?, ?)', sources.items())
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def build_mosaic_set(store_root, api, zoom, windows, n, path, workers=None, batch_size=64):
+    # Build the n x n mosaics of the windows whose tiles are all in the store.
+    # A mosaic is only rebuilt when its input tiles changed. Returns the number
+    # of built mosaics, and the tiles missing from the store
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with TileStore(store_root) as store:
+        tile_ids = store.tile_ids(api, zoom)
+
+    index = MosaicIndex(path)
+    try:
+        built = index.sources()
+        todo, sources, missing = [], {}, set()
+        for x0, y0 in windows.tolist():
+            tiles = window_tiles(x0, y0, n)
+            ids = [tile_ids.get(tile) for tile in tiles]
+            if None in ids:
+                missing.update(tile for tile, tile_id in zip(tiles, ids) if tile_id is None)
+                continue
+            name = f'{zoom}_{x0}_{y0}_{n}x{n}'
+            sources[name] = fingerprint(ids)
+            if built.get(name) != sources[name]:
+                todo.append((name, ids))
+
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(build_mosaics, store_root, api, batch, n, path) for batch in batches]
+            for batch, future in zip(batches, futures):
+                future.result()
+                index.update({name: sources[name] for name, _ in batch})
+    finally:
+        index.close()
+    return len(todo), sorted(missing)
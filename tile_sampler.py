@@ -0,0 +1,75 @@
+import numpy as np
+import shapely
+
+from grid_index import edges_boundary_mask
+from tile_utils import deg2num_array, num2deg_array
+
+
+def region_tiles(bounds, zoom):
+    # Range of the x and y indices of the tiles covering the bounds
+    xmin, ymin, xmax, ymax = bounds
+    x0, y0 = deg2num_array(ymax, xmin, zoom)
+    x1, y1 = deg2num_array(ymin, xmax, zoom)
+    return np.arange(int(x0), int(x1) + 1), np.arange(int(y0), int(y1) + 1)
+
+
+def tile_coverage(geometry, zoom, block_size=64):
+    # Fraction of each tile of the region bounds covered by the geometry (in lon/lat).
+    # Tiles away from the boundary are fully inside or outside, and are classified by a
+    # single point test (per block of block_size x block_size tiles when possible). Only
+    # the tiles crossed by the boundary are intersected, with the geometry clipped to their block
+    shapely.prepare(geometry)
+    xs, ys = region_tiles(geometry.bounds, zoom)
+    nx, ny = len(xs), len(ys)
+
+    # Tile edges in lon/lat, tiles are rectangles in lon/lat. The y index grows to the south
+    lat_edges, _ = num2deg_array(0, np.arange(ys[0], ys[-1] + 2), zoom)
+    _, lon_edges = num2deg_array(np.arange(xs[0], xs[-1] + 2), 0, zoom)
+    boundary = edges_boundary_mask(geometry, lon_edges, lat_edges[::-1])[:, ::-1]
+
+    coverage = np.zeros((nx, ny), dtype=np.float32)
+    for i0 in range(0, nx, block_size):
+        for j0 in range(0, ny, block_size):
+            i1, j1 = min(i0 + block_size, nx), min(j0 + block_size, ny)
+            block_boundary = boundary[i0:i1, j0:j1]
+            rect = (lon_edges[i0], lat_edges[j1], lon_edges[i1], lat_edges[j0])
+
+            if not block_boundary.any():
+                # The whole block is inside or outside
+                center = ((rect[0] + rect[2]) / 2, (rect[1] + rect[3]) / 2)
+                coverage[i0:i1, j0:j1] = float(shapely.contains_xy(geometry, *center))
+                continue
+
+            clipped = shapely.clip_by_rect(geometry, *rect)
+            if not clipped.is_valid:
+                clipped = shapely.make_valid(clipped)
+            shapely.prepare(clipped)
+
+            # Tiles of the block away from the boundary, test their center
+            i, j = np.nonzero(~block_boundary)
+            lat, lon = num2deg_array(xs[i0 + i] + 0.5, ys[j0 + j] + 0.5, zoom)
+            coverage[i0 + i, j0 + j] = shapely.contains_xy(clipped, lon, lat)
+
+            # Tiles crossed by the boundary, intersect them with the geometry
+            i, j = np.nonzero(block_boundary)
+            boxes = shapely.box(lon_edges[i0 + i], lat_edges[j0 + j + 1], lon_edges[i0 + i + 1], lat_edges[j0 + j])
+            coverage[i0 + i, j0 + j] = shapely.area(shapely.intersection(clipped, boxes)) / shapely.area(boxes)
+
+    return xs, ys, np.clip(coverage, 0, 1)
+
+
+def sample_tiles(xs, ys, coverage, num_tiles, min_coverage, seed):
+    # Sample distinct tiles, without replacement, among the tiles covered above min_coverage
+    i, j = np.nonzero((coverage > 0) & (coverage >= min_coverage))
+    if num_tiles > len(i):
+        raise ValueError(f"Only {len(i)} tiles have a coverage of at least {min_coverage}, "
+                         f"cannot sample {num_tiles} tiles")
+    chosen = np.random.default_rng(seed).choice(len(i), size=num_tiles, replace=False)
+    tiles = np.column_stack((xs[i[chosen]], ys[j[chosen]]))
+    return tiles, coverage[i[chosen], j[chosen]]
+
+
+def tile_centers(tiles, zoom):
+    # (lon, lat) of the center of each tile, in the format of the points files
+    lat, lon = num2deg_array(tiles[:, 0] + 0.5, tiles[:, 1] + 0.5, zoom)
+    return np.column_stack((lon, lat))
@@ -0,0 +1,195 @@
+import hashlib
+import os
+import pathlib
+import sqlite3
+
+
+class TileStore:
+    # Tile store shared across datasets, keyed by (provider, z, x, y).
+    # Each provider is packed in a deduplicated MBTiles file, where identical
+    # tiles (e.g. blank placeholders) are stored once and referenced by their sha256.
+
+    def __init__(self, root, commit_every=1000, read_only=False):
+        # A read-only store (e.g. the shared store read by a shard) is never written to,
+        # and a provider missing from it is an empty store
+        self.root = root
+        self.commit_every = commit_every
+        self.read_only = read_only
+        self.pending = {}
+        self.conns = {}
+        if not read_only and not os.path.exists(root):
+            os.makedirs(root)
+
+    def connect(self, api):
+        if api in self.conns:
+            return self.conns[api]
+        path = f'{self.root}/{api}.mbtiles'
+        if self.read_only and os.path.exists(path):
+            conn = sqlite3.connect(f'{pathlib.Path(path).resolve().as_uri()}?mode=ro', uri=True, timeout=60)
+            self.conns[api] = conn
+            self.pending[api] = 0
+            return conn
+        conn = sqlite3.connect(':memory:' if self.read_only else path, timeout=60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+            CREATE TABLE IF NOT EXISTS map (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                tile_id TEXT,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );
+            CREATE TABLE IF NOT EXISTS invalid (tile_id TEXT PRIMARY KEY, reason TEXT);
+            CREATE TABLE IF NOT EXISTS derived (
+                zoom_level INTEGER,
+                tile_column INTEGER,
+                tile_row INTEGER,
+                sources TEXT,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );
+            CREATE VIEW IF NOT EXISTS tiles AS
+                SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,
+                       map.tile_row AS tile_row, images.tile_data AS tile_data
+                FROM map JOIN images ON images.tile_id = map.tile_id;
+        """)
+        conn.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('name', api))
+        conn.commit()
+        self.conns[api] = conn
+        self.pending[api] = 0
+        return conn
+
+    @staticmethod
+    def tms_row(zoom, y):
+        # MBTiles stores rows in TMS order (y axis pointing north)
+        return (1 << zoom) - 1 - y
+
+    def tile_ids(self, api, zoom):
+        # Dict of (x, y) -> tile_id of the tiles in the store
+        rows = self.connect(api).execute('SELECT tile_column, tile_row, tile_id FROM map WHERE zoom_level = ?',
+                                         (zoom,))
+        return {(x, self.tms_row(zoom, row)): tile_id for x, row, tile_id in rows}
+
+    def info(self, api, zoom, x, y):
+        # (size, sha256) of a stored tile, or None if it is not in the store
+        return self.connect(api).execute(
+            'SELECT length(images.tile_data), map.tile_id FROM map JOIN images ON images.tile_id = map.tile_id '
+            'WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (zoom, x, self.tms_row(zoom, y))).fetchone()
+
+    def lookup(self, api, zoom, tiles):
+        # Dict of (x, y) -> (size, sha256) of the given tiles which are in the store, in one
+        # query for a batch of tiles (through a temporary table, as in remove), instead of
+        # loading the keys of the whole store
+        conn = self.connect(api)
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (tile_column INTEGER, tile_row INTEGER)')
+        conn.execute('DELETE FROM lookup')
+        conn.executemany('INSERT INTO lookup VALUES (?, ?)', [(x, self.tms_row(zoom, y)) for x, y in tiles])
+        rows = conn.execute(
+            'SELECT map.tile_column, map.tile_row, length(images.tile_data), map.tile_id FROM lookup '
+            'JOIN map ON map.zoom_level = ? AND map.tile_column = lookup.tile_column AND map.tile_row = lookup.tile_row '
+            'JOIN images ON images.tile_id = map.tile_id', (zoom,))
+        return {(x, self.tms_row(zoom, row)): (size, tile_id) for x, row, size, tile_id in rows}
+
+    def get(self, api, zoom, x, y):
+        row = self.connect(api).execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+            (zoom, x, self.tms_row(zoom, y))).fetchone()
+        return None if row is None else row[0]
+
+    def get_image(self, api, tile_id):
+        row = self.connect(api).execute('SELECT tile_data FROM images WHERE tile_id = ?', (tile_id,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, api, zoom, x, y, data, tile_id=None):
+        conn = self.connect(api)
+        if tile_id is None:
+            tile_id = hashlib.sha256(data).hexdigest()
+        conn.execute('INSERT OR IGNORE INTO images VALUES (?, ?)', (tile_id, data))
+        conn.execute('INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)', (zoom, x, self.tms_row(zoom, y), tile_id))
+        # Commit in batches
+        self.pending[api] += 1
+        if self.pending[api] >= self.commit_every:
+            self.commit(api)
+        return tile_id
+
+    def put_file(self, api, zoom, x, y, path, tile_id=None):
+        with open(path, 'rb') as f:
+            return self.put(api, zoom, x, y, f.read(), tile_id=tile_id)
+
+    def derived(self, api, zoom):
+        # Dict of (x, y) -> sources fingerprint of the tiles built from other tiles (see tile_pyramid.py)
+        rows = self.connect(api).execute('SELECT tile_column, tile_row, sources FROM derived WHERE zoom_level = ?',
+                                         (zoom,))
+        return {(x, self.tms_row(zoom, row)): sources for x, row, sources in rows}
+
+    def put_derived(self, api, zoom, x, y, data, sources):
+        self.connect(api).execute('INSERT OR REPLACE INTO derived VALUES (?, ?, ?, ?)',
+                                  (zoom, x, self.tms_row(zoom, y), sources))
+        return self.put(api, zoom, x, y, data)
+
+    def merge(self, root, api):
+        # Add the tiles of the provider in another store (e.g. of a shard)
+        path = f'{root}/{api}.mbtiles'
+        if not os.path.exists(path):
+            return
+        conn = self.connect(api)
+        self.commit(api)
+        conn.execute('ATTACH DATABASE ? AS other', (path,))
+        try:
+            conn.execute('INSERT OR IGNORE INTO images SELECT * FROM other.images')
+            conn.execute('INSERT OR REPLACE INTO map SELECT * FROM other.map')
+            conn.execute('INSERT OR REPLACE INTO invalid SELECT * FROM other.invalid')
+            conn.execute('INSERT OR REPLACE INTO derived SELECT * FROM other.derived')
+            conn.commit()
+        finally:
+            conn.execute('DETACH DATABASE other')
+
+    def export(self, api, zoom, x, y, path):
+        # Write a stored tile to a file, returns False if it is not in the store
+        data = self.get(api, zoom, x, y)
+        if data is None:
+            return False
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+
+    def flag(self, api, reasons):
+        # Record the invalid tile contents, a dict of tile_id -> reason (see tile_validation.py)
+        conn = self.connect(api)
+        conn.executemany('INSERT OR REPLACE INTO invalid VALUES (?, ?)', reasons.items())
+        conn.commit()
+
+    def flagged(self, api):
+        # Dict of tile_id -> reason of the invalid tile contents
+        return dict(self.connect(api).execute('SELECT tile_id, reason FROM invalid'))
+
+    def remove(self, api, tile_ids):
+        # Remove tile contents, and every tile referencing them, from the store
+        # (map is not indexed by tile_id, so the ids go through a temporary table)
+        conn = self.connect(api)
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS removed (tile_id TEXT PRIMARY KEY)')
+        conn.execute('DELETE FROM removed')
+        conn.executemany('INSERT OR IGNORE INTO removed VALUES (?)', [(tile_id,) for tile_id in tile_ids])
+        conn.execute('DELETE FROM map WHERE tile_id IN (SELECT tile_id FROM removed)')
+        conn.execute('DELETE FROM images WHERE tile_id IN (SELECT tile_id FROM removed)')
+        conn.commit()
+
+    def commit(self, api=None):
+        for name in ([api] if api is not None else list(self.conns)):
+            self.conns[name].commit()
+            self.pending[name] = 0
+
+    def close(self):
+        self.commit()
+        for conn in self.conns.values():
+            conn.close()
+        self.conns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,111 @@
+import math
+import numpy as np
+
+
+def deg2num(lat_deg, lon_deg, zoom):
+    lat_rad = math.radians(lat_deg)
+    n = 2.0 ** zoom
+    xtile = int((lon_deg + 180.0) / 360.0 * n)
+    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return xtile, ytile
+
+
+def deg2num_array(lat_deg, lon_deg, zoom):
+    # Vectorized deg2num, for arrays of latitudes and longitudes
+    xtile, ytile = deg2frac_array(lat_deg, lon_deg, zoom)
+    return np.floor(xtile).astype(np.int64), np.floor(ytile).astype(np.int64)
+
+
+def deg2frac_array(lat_deg, lon_deg, zoom):
+    # Fractional tile indices of the points, the position inside their tile
+    lat_rad = np.radians(lat_deg)
+    n = 2.0 ** zoom
+    xtile = (np.asarray(lon_deg) + 180.0) / 360.0 * n
+    ytile = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return xtile, ytile
+
+
+def num2deg_array(xtile, ytile, zoom):
+    # Inverse of deg2num_array: (lat, lon) of the north-west corner of the tiles,
+    # or of any point inside them for fractional tile indices
+    n = 2.0 ** zoom
+    lon_deg = np.asarray(xtile, dtype=np.float64) / n * 360.0 - 180.0
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(ytile, dtype=np.float64) / n))))
+    return lat_deg, lon_deg
+
+
+def unique_tiles(coordinates, zoom):
+    # Convert the (lon, lat) coordinates to tile indices in one pass
+    xtile, ytile = deg2num_array(coordinates[:, 1], coordinates[:, 0], zoom)
+    
+    # Reduce them to the unique tiles, keeping the tile of each point
+    tiles, point_tile = np.unique(np.column_stack((xtile, ytile)), axis=0, return_inverse=True)
+    
+    # Array of shape (ntiles, 2) with (x, y), and the tile index of each point
+    return tiles, point_tile.reshape(-1)
+
+
+def stream_unique_tiles(point_chunks, zoom, tile_index):
+    # Streaming version of unique_tiles, for chunks of (lon, lat) coordinates.
+    # tile_index maps each (x, y) tile seen so far to its index, and is filled
+    # as new tiles appear. Yields each chunk, the tile index of its points
+    # and the list of tiles that had not been seen before
+    for chunk in point_chunks:
+        xtile, ytile = deg2num_array(chunk[:, 1], chunk[:, 0], zoom)
+        chunk_tiles, inverse = np.unique(np.column_stack((xtile, ytile)), axis=0, return_inverse=True)
+        
+        ids = np.empty(len(chunk_tiles), dtype=np.int64)
+        new_tiles = []
+        for i, tile in enumerate(map(tuple, chunk_tiles.tolist())):
+            if tile not in tile_index:
+                tile_index[tile] = len(tile_index)
+                new_tiles.append(tile)
+            ids[i] = tile_index[tile]
+        
+        yield chunk, ids[inverse.reshape(-1)], new_tiles
+
+
+def tile_keys(xtile, ytile):
+    # Pack (x, y) tile indices into a single integer key
+    return (np.asarray(xtile, dtype=np.uint64) << np.uint64(32)) | np.asarray(ytile, dtype=np.uint64)
+
+
+def hash_uniform(keys, seed=0):
+    # Stateless hash of integer keys to uniform floats in [0, 1) (splitmix64),
+    # the same key always gets the same value for a given seed
+    with np.errstate(over='ignore'):
+        z = np.asarray(keys, dtype=np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+def parse_shard(shard):
+    # 'i/N' -> (i, N), shards are numbered from 0 to N - 1
+    index, num_shards = (int(value) for value in shard.split('/'))
+    if not 0 <= index < num_shards:
+        raise ValueError(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+    return index, num_shards
+
+
+def tile_shards(tiles, num_shards, block_size=1):
+    # Shard of each (x, y) tile, from the hash of its key, or of the key of its block of
+    # block_size x block_size tiles to keep neighbouring tiles together. Every host
+    # computes the same shards, without any coordination
+    tiles = np.asarray(tiles, dtype=np.int64).reshape(-1, 2)
+    keys = tile_keys(tiles[:, 0] // block_size, tiles[:, 1] // block_size)
+    return np.floor(hash_uniform(keys) * num_shards).astype(np.int64)
+
+
+def shard_path(tiles_path, index, num_shards):
+    return f'{tiles_path}/shard-{index:03d}-of-{num_shards:03d}'
+
+
+def save_point_tiles(path, tiles, point_tile, zoom):
+    np.savez(path, tiles=tiles, point_tile=point_tile, zoom=zoom)
+
+
+def load_point_tiles(path):
+    data = np.load(path)
+    return data['tiles'], data['point_tile'], int(data['zoom'])
@@ -0,0 +1,167 @@
+import sqlite3
+import struct
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+# Reasons for a tile content to be invalid. Placeholders are valid images, identical
+# across many tiles (e.g. "map data not yet available"), they are kept in the store
+# but not used for training. The other tiles are broken, and downloaded again
+EMPTY = 'empty'
+NOT_IMAGE = 'not_image'
+TRUNCATED = 'truncated'
+BAD_SIZE = 'bad_size'
+PLACEHOLDER = 'placeholder'
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+JPEG_END = b'\xff\xd9'
+# JPEG start of frame markers, holding the image size
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_format(data):
+    # Sniff the image format from its magic bytes, without decoding it
+    if data[:8] == PNG_SIGNATURE:
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    return None
+
+
+def jpeg_size(data):
+    # Walk the JPEG segments up to the start of frame
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # Standalone markers
+            i += 2
+            continue
+        if marker in JPEG_SOF:
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+
+def webp_size(data):
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and len(data) >= 30:
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and len(data) >= 25:
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(data) >= 30:
+        return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+    return None
+
+
+def image_size(data, kind):
+    # (width, height) from the image header, or None if it cannot be read
+    if kind == 'png':
+        if data[12:16] != b'IHDR' or len(data) < 24:
+            return None
+        return struct.unpack('>II', data[16:24])
+    if kind == 'jpg':
+        return jpeg_size(data)
+    if kind == 'webp':
+        return webp_size(data)
+    if kind == 'gif':
+        return struct.unpack('<HH', data[6:10]) if len(data) >= 10 else None
+    return None
+
+
+def check_tile(data, tile_size=256):
+    # Reason for the tile content to be invalid, or None if it is a valid image.
+    # Only the headers and the end of the image are read, nothing is decoded
+    if not data:
+        return EMPTY
+    kind = image_format(data)
+    if kind is None:
+        # e.g. an HTML error page
+        return NOT_IMAGE
+    if kind == 'png' and not data.endswith(PNG_END):
+        return TRUNCATED
+    if kind == 'jpg' and not data.rstrip(b'\x00').endswith(JPEG_END):
+        return TRUNCATED
+    if kind == 'webp' and int.from_bytes(data[4:8], 'little') + 8 > len(data):
+        return TRUNCATED
+    if kind == 'gif' and not data.endswith(b';'):
+        return TRUNCATED
+    size = image_size(data, kind)
+    if size is None:
+        return TRUNCATED
+    if tile_size and tuple(size) != (tile_size, tile_size):
+        return BAD_SIZE
+    return None
+
+
+def check_rows(path, start, end, tile_size):
+    # Check the tile contents of an MBTiles file with rowid in [start, end),
+    # returns a dict of tile_id -> reason of the invalid ones
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=60)
+    try:
+        rows = conn.execute('SELECT tile_id, tile_data FROM images WHERE rowid >= ? AND rowid < ?', (start, end))
+        reasons = {}
+        for tile_id, data in rows:
+            reason = check_tile(data, tile_size)
+            if reason is not None:
+                reasons[tile_id] = reason
+        return reasons
+    finally:
+        conn.close()
+
+
+def content_counts(path):
+    # Number of tiles referencing each tile content of an MBTiles file
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=60)
+    try:
+        return dict(conn.execute('SELECT tile_id, COUNT(*) FROM map GROUP BY tile_id'))
+    finally:
+        conn.close()
+
+
+def find_placeholders(path, max_duplicates=0, known=()):
+    # Tile contents referenced by more than max_duplicates tiles (0 to disable: uniform
+    # map tiles, e.g. sea or forest, are legitimately identical), or known placeholders
+    return {tile_id for tile_id, count in content_counts(path).items()
+            if (max_duplicates and count > max_duplicates) or tile_id in known}
+
+
+def validate_mbtiles(path, tile_size=256, max_duplicates=0, known_placeholders=(), workers=None,
+                     chunk_size=5000):
+    # Validate every tile content of an MBTiles file in parallel, each worker reads
+    # its own rowid range. Returns a dict of tile_id -> reason of the invalid ones
+    conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=60)
+    try:
+        low, high = conn.execute('SELECT MIN(rowid), MAX(rowid) FROM images').fetchone()
+    finally:
+        conn.close()
+    if low is None:
+        return {}
+
+    reasons = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(check_rows, path, start, start + chunk_size, tile_size)
+                   for start in range(low, high + 1, chunk_size)]
+        for future in futures:
+            reasons.update(future.result())
+
+    for tile_id in find_placeholders(path, max_duplicates, known_placeholders):
+        reasons.setdefault(tile_id, PLACEHOLDER)
+    return reasons
+
+
+def summarize(reasons):
+    return dict(Counter(reasons.values()))
@@ -0,0 +1,117 @@
+import argparse
+import glob
+import os
+
+from tile_manifest import TileManifest, STATUS_FAILED, STATUS_BLANK, STATUS_DONE
+from tile_store import TileStore
+from tile_validation import validate_mbtiles, summarize, content_counts, PLACEHOLDER
+
+
+def parse_args(argv=None):
+    # Initialize the argument parser
+    parser = argparse.ArgumentParser(description='Validate the downloaded tiles of the shared tile store.')
+
+    parser.add_argument('--apis',
+                        type=str,
+                        nargs='+',
+                        default=['worldimagery-clarity', 'openstreetmap'],
+                        help='APIs to validate. Example: worldimagery-clarity, openstreetmap.')
+    parser.add_argument('--tile_size',
+                        type=int,
+                        default=256,
+                        help='Expected width and height of the tiles in pixels, 0 to accept any size.')
+    parser.add_argument('--max_duplicates',
+                        type=int,
+                        default=0,
+                        help='Identical tiles shared by more tiles than this are placeholders, 0 (default) to disable. '
+                             'Only for imagery providers, e.g. 100: uniform map tiles (sea, forest) are legitimately identical.')
+    parser.add_argument('--placeholders',
+                        type=str,
+                        default=None,
+                        help='File with the sha256 of known placeholder tiles, one per line.')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of parallel validation workers.')
+    parser.add_argument('--dry_run',
+                        action='store_true',
+                        default=False,
+                        help='Only report the invalid tiles, without changing the store and the manifests.')
+    parser.add_argument('--save_root',
+                        type=str,
+                        default='dataset',
+                        help='Root folder of the tiles.')
+    parser.add_argument('--store',
+                        type=str,
+                        default=None,
+                        help='Shared tile store folder. Default: {save_root}/tile_store.')
+
+    # Parse the arguments
+    args = parser.parse_args(argv)
+
+    # HACK: Manually set the arguments
+    if args.store is None:
+        args.store = f'{args.save_root}/tile_store'
+
+    return args
+
+
+def main(args=None):
+
+    if args is None:
+        args = parse_args()
+
+    known_placeholders = set()
+    if args.placeholders is not None:
+        with open(args.placeholders) as f:
+            known_placeholders = {line.strip() for line in f if line.strip()}
+
+    # Manifests of every dataset sharing the store
+    manifests = sorted(glob.glob(f'{args.save_root}/tiles_*/manifest.sqlite'))
+
+    # Number of invalid tile contents of each API
+    invalid = {}
+    for api in args.apis:
+        path = f'{args.store}/{api}.mbtiles'
+        if not os.path.exists(path):
+            print(f"{api}: no tiles in the store")
+            continue
+
+        reasons = validate_mbtiles(path, tile_size=args.tile_size, max_duplicates=args.max_duplicates,
+                                   known_placeholders=known_placeholders, workers=args.workers)
+        print(f"{api}: {len(reasons)} invalid tile contents {summarize(reasons)}")
+        invalid[api] = len(reasons)
+
+        broken = [tile_id for tile_id, reason in reasons.items() if reason != PLACEHOLDER]
+        placeholders = [tile_id for tile_id, reason in reasons.items() if reason == PLACEHOLDER]
+
+        # Report the placeholder contents before marking them, with the number of tiles of each,
+        # so that legitimate duplicates can be spotted (and known ones kept in --placeholders)
+        if placeholders:
+            counts = content_counts(path)
+            for tile_id in sorted(placeholders, key=lambda tile_id: -counts.get(tile_id, 0)):
+                print(f"  placeholder {tile_id}: {counts.get(tile_id, 0)} tiles")
+
+        if args.dry_run or not reasons:
+            continue
+
+        # Flag the invalid contents, so that new downloads are checked against them, and
+        # remove the broken ones from the store, so that they are not reused
+        with TileStore(args.store) as store:
+            store.flag(api, reasons)
+            store.remove(api, broken)
+
+        # Broken tiles are failed, so that the next download run fetches them again,
+        # and placeholder tiles are blank, so that they are not exported
+        for manifest_path in manifests:
+            with TileManifest(manifest_path) as manifest:
+                requeued = manifest.mark(api, broken, STATUS_FAILED)
+                blank = manifest.mark(api, placeholders, STATUS_BLANK, from_statuses=(STATUS_DONE,))
+            if requeued or blank:
+                print(f"{manifest_path}: {requeued} tiles to download again, {blank} blank tiles")
+
+    return invalid
+
+
+if __name__ == '__main__':
+    main()